@@ -8,6 +8,11 @@ In order to daemonize gunicorn add -D flag:
 
     gunicorn -c gunicorn_cfg.py run:app -D
 
+Only one of the workers monitors jobs. To monitor jobs in a separate process
+set MONITOR_MODE = 'external' and run:
+
+    sqmpy-monitor -c config.py
+
 """
 import multiprocessing
 
@@ -15,7 +20,9 @@ import multiprocessing
 # Gunicorn will listen on the given host:port
 bind = '0.0.0.0:5000'
 
-# The only tested worker class is gevent
+# The only tested worker class is gevent. Job state and output streams keep
+# a synchronous worker busy for up to EVENTS_MAX_STREAM_TIME seconds, use
+# gevent before setting LIVE_UPDATES.
 # worker_class = 'gevent'
 
 # Set number of workers based on CPU count
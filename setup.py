@@ -42,4 +42,7 @@ setup(name='sqmpy',
                         'py-bcrypt',
                         'names',
                         'gevent'],
+      extras_require={'postgresql': ['psycopg2']},
+      entry_points={'console_scripts':
+                    ['sqmpy-monitor = sqmpy.factory:monitor_main']},
       )
@@ -1,6 +1,78 @@
 """DB module."""
+import sqlalchemy
+from sqlalchemy import event
 from flask_sqlalchemy import SQLAlchemy
 
+# Engine options of connection pools, which only apply to server databases
+_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+class _SQLAlchemy(SQLAlchemy):
+    """
+    Uses connection pool settings for server databases, such as PostgreSQL,
+    and tunes SQLite connections for concurrent access.
+    """
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('sqlite'):
+            # SQLite connections are not pooled
+            for option in _POOL_OPTIONS:
+                options.pop(option, None)
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
 
 # Create database
-db = SQLAlchemy()
+db = _SQLAlchemy()
+
+
+def configure_engine(app):
+    """
+    Configure connections of the database engine. For SQLite databases the
+    write ahead log is enabled, so that readers do not block the writer, and
+    writers wait for locks instead of failing with `database is locked'.
+    Should be called within an application context before the first query.
+    :param app: flask application
+    """
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+    config = app.config
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(connection, connection_record):
+        cursor = connection.cursor()
+        if config.get('SQLITE_WAL'):
+            cursor.execute('PRAGMA journal_mode=WAL')
+        if config.get('SQLITE_SYNCHRONOUS'):
+            cursor.execute('PRAGMA synchronous={0}'
+                           .format(config['SQLITE_SYNCHRONOUS']))
+        if config.get('SQLITE_BUSY_TIMEOUT'):
+            cursor.execute('PRAGMA busy_timeout={0:d}'
+                           .format(config['SQLITE_BUSY_TIMEOUT']))
+        cursor.close()
+
+
+def upgrade_schema():
+    """
+    Add columns and indexes of models which are missing in existing tables.
+    This lets an existing database be used after new columns or indexes are
+    added to models, since `create_all' only creates missing tables. Should
+    be called within an application context after `create_all'.
+    """
+    engine = db.engine
+    inspector = sqlalchemy.inspect(engine)
+    for table in db.metadata.sorted_tables:
+        existing_columns = \
+            set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            engine.execute('ALTER TABLE {table} ADD COLUMN {column} {type}'
+                           .format(table=table.name,
+                                   column=column.name,
+                                   type=column.type.compile(engine.dialect)))
+        existing_indexes = \
+            set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(engine)
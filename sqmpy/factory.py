@@ -1,8 +1,15 @@
+import os
+import argparse
+import mimetypes
+
+import click
 from flask import Flask
 from flask_wtf.csrf import CSRFProtect
 from flask_sqlalchemy import SQLAlchemy
 
+from sqmpy.job.events import JobStatePoller
 from sqmpy.job.monitor import JobMonitorThread
+from sqmpy.job.submission import JobSubmissionPool
 
 
 def create_app(config_filename=None, **kwargs):
@@ -14,6 +21,10 @@ def create_app(config_filename=None, **kwargs):
     # Initialize flask app
     app = Flask(__name__.split('.')[0], static_url_path='')
 
+    # Compute checksums of uploaded files while receiving them
+    from sqmpy.job.helpers import ChecksumRequest
+    app.request_class = ChecksumRequest
+
     # Import default configs
     app.config.from_object('sqmpy.defaults')
 
@@ -30,9 +41,19 @@ def create_app(config_filename=None, **kwargs):
     # Updated with keyword arguments
     app.config.update(kwargs)
 
+    # Register extra mime types of job files
+    for extension, mimetype in app.config.get('EXTRA_MIMETYPES', {}).items():
+        mimetypes.add_type(mimetype, extension)
+
     # Register app on db
-    from sqmpy.database import db
+    from sqmpy.database import db, upgrade_schema, configure_engine
     db.init_app(app)
+    with app.app_context():
+        configure_engine(app)
+
+    # Configure pooled connections to remote resources
+    from sqmpy.job.saga_helper import job_service_pool
+    job_service_pool.configure(app.config)
 
     csrf = CSRFProtect()
     # Activate CSRF protection
@@ -41,10 +62,11 @@ def create_app(config_filename=None, **kwargs):
 
     # Register blueprints
     from sqmpy.security import security_blueprint
-    from sqmpy.job import job_blueprint
+    from sqmpy.job import job_blueprint, api_blueprint
     from sqmpy.views import main_blueprint
     app.register_blueprint(security_blueprint)
     app.register_blueprint(job_blueprint)
+    app.register_blueprint(api_blueprint)
     app.register_blueprint(main_blueprint)
 
     if __debug__:
@@ -52,6 +74,13 @@ def create_app(config_filename=None, **kwargs):
         # code they are imported along with blue_print imports above.
         with app.app_context():
             db.create_all()
+            upgrade_schema()
+
+    @app.cli.command('collect-garbage')
+    def collect_garbage():
+        """Remove stored files which no job refers to anymore."""
+        from sqmpy.job import blobstore
+        click.echo('Removed %s files.' % blobstore.collect_garbage())
 
     # A global context processor for sub menu items
     @app.context_processor
@@ -63,10 +92,67 @@ def create_app(config_filename=None, **kwargs):
         else:
             return {}
 
+    @app.cli.command('monitor')
+    def monitor():
+        """Monitor jobs until interrupted."""
+        run_monitor(app)
+
+    # Jobs sent to a monitor which is not started are monitored by the
+    # leader monitor, see MONITOR_MODE.
+    app.monitor = JobMonitorThread(kwargs={'app': app})
+
     @app.before_first_request
     def activate_job_monitor():
-        thread = JobMonitorThread(kwargs={'app': app})
-        app.monitor = thread
-        thread.start()
+        # Without discovery every process monitors the jobs it submits
+        if app.config.get('MONITOR_MODE') == 'embedded' or \
+                not app.monitor.discovery:
+            app.monitor.start()
+
+    @app.before_first_request
+    def activate_job_state_poller():
+        poller = JobStatePoller(app, name='sqmpy-job-state-poller')
+        app.job_state_poller = poller
+        poller.start()
+
+    @app.before_first_request
+    def activate_job_submitter():
+        if app.config.get('ASYNC_SUBMISSION'):
+            submitter = \
+                JobSubmissionPool(app, app.config.get('SUBMISSION_WORKERS'))
+            app.submitter = submitter
+            submitter.start()
 
     return app
+
+
+def run_monitor(app):
+    """
+    Run the job monitor of the given application in the foreground until it
+    is interrupted.
+    :param app: flask application
+    """
+    if not app.monitor.discovery:
+        app.logger.error('Users connect to resources with their login '
+                         'information, jobs are monitored by the processes '
+                         'which submit them.')
+        return
+    app.logger.info('Waiting for the monitor lock...')
+    app.monitor.start()
+    try:
+        while app.monitor.is_alive():
+            app.monitor.join(1)
+    except KeyboardInterrupt:
+        app.monitor.close()
+
+
+def monitor_main():
+    """
+    Entry point of `sqmpy-monitor', which runs the job monitor in a process
+    of its own.
+    """
+    parser = argparse.ArgumentParser(description='Monitor sqmpy jobs.')
+    parser.add_argument('-c', '--config',
+                        help='path of a config file to load')
+    args = parser.parse_args()
+    run_monitor(create_app(os.path.abspath(args.config)
+                           if args.config else None))
@@ -5,8 +5,9 @@
     Provides job submission and monitoring.
 """
 from sqmpy.job.views import job_blueprint
+from sqmpy.job.api import api_blueprint
 
 
 __author__ = 'Mehdi Sadeghi'
 
-__all__ = [job_blueprint]
+__all__ = [job_blueprint, api_blueprint]
@@ -0,0 +1,239 @@
+"""
+    sqmpy.job.api
+    ~~~~~~~~~~~~~
+
+    JSON API for jobs and their files
+"""
+import hashlib
+
+from flask import Blueprint, request, jsonify, abort, url_for, current_app
+from flask_login import login_required
+from sqlalchemy.orm import defer
+
+from sqmpy.job import manager as job_services
+from sqmpy.job.constants import FileRelation, ScriptType, HPCBackend
+from sqmpy.job.exceptions import JobManagerException
+from sqmpy.job.models import Job
+from sqmpy.job.pagination import newest_first, make_cursor
+
+__author__ = 'Mehdi Sadeghi'
+
+
+api_blueprint = Blueprint('api', __name__, url_prefix='/api')
+
+
+def _format_date(value):
+    return value.isoformat() if value else None
+
+
+def _format_enum(enum_class):
+    def format_value(value):
+        return enum_class(value).name if value is not None else None
+    return format_value
+
+
+# Job fields and functions to make json values of them. Only default fields
+# are sent, unless fields are requested with the `fields' argument.
+JOB_FIELDS = {
+    'id': None,
+    'submit_date': _format_date,
+    'last_status': None,
+    'last_status_change': _format_date,
+    'remote_job_id': None,
+    'remote_dir': None,
+    'resource_endpoint': None,
+    'script': None,
+    'script_type': _format_enum(ScriptType),
+    'arguments': None,
+    'hpc_backend': _format_enum(HPCBackend),
+    'description': None,
+    'queue': None,
+    'total_physical_memory': None,
+    'project': None,
+    'total_cpu_count': None,
+    'spmd_variation': None,
+    'walltime_limit': None,
+    'owner_id': None,
+    'resource_id': None,
+}
+JOB_DEFAULT_FIELDS = \
+    tuple(sorted(field for field in JOB_FIELDS if field != 'script'))
+
+FILE_FIELDS = {
+    'id': None,
+    'name': None,
+    'original_name': None,
+    'relation': _format_enum(FileRelation),
+    'relative_path': None,
+    'checksum': None,
+    'size': None,
+    'modified': None,
+}
+FILE_DEFAULT_FIELDS = tuple(sorted(FILE_FIELDS))
+
+
+def _get_fields(allowed_fields, default_fields):
+    """
+    Returns fields requested with the comma separated `fields' argument.
+    """
+    if not request.args.get('fields'):
+        return default_fields
+    fields = request.args['fields'].split(',')
+    unknown = set(fields) - set(allowed_fields)
+    if unknown:
+        abort(400, 'Unknown fields: %s' % ', '.join(sorted(unknown)))
+    return fields
+
+
+def _serialize(obj, fields, formatters):
+    result = {}
+    for field in fields:
+        value = getattr(obj, field)
+        formatter = formatters[field]
+        result[field] = formatter(value) if formatter else value
+    return result
+
+
+def _make_etag(*values):
+    return hashlib.md5(repr(values)).hexdigest()
+
+
+def _make_response(data, etag):
+    """
+    Make a json response with the given etag. If the client already has the
+    same version, an empty `304 Not Modified' response is returned instead.
+    """
+    response = jsonify(data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+@api_blueprint.errorhandler(400)
+@api_blueprint.errorhandler(403)
+@api_blueprint.errorhandler(404)
+def handle_error(error):
+    """
+    Return errors as json
+    """
+    response = jsonify({'error': error.description})
+    response.status_code = error.code
+    return response
+
+
+@api_blueprint.route('/jobs', methods=['GET'])
+@login_required
+def list_jobs():
+    """
+    List jobs of the current user, newest first. Arguments:
+        fields: comma separated names of fields to return
+        last_status: only return jobs in this state
+        resource: only return jobs of the resource with this url or name
+        limit: number of jobs to return
+        after: `next' cursor of the previous page
+    :return:
+    """
+    fields = _get_fields(JOB_FIELDS, JOB_DEFAULT_FIELDS)
+    limit = request.args.get('limit',
+                             current_app.config.get('PER_PAGE'),
+                             type=int)
+    if not limit or limit < 1:
+        abort(400, 'Invalid limit')
+    limit = min(limit, current_app.config.get('API_MAX_PAGE_SIZE', limit))
+
+    query = job_services.filter_jobs(
+        last_status=request.args.get('last_status'),
+        resource=request.args.get('resource'))
+    if 'script' not in fields:
+        query = query.options(defer(Job.script))
+    try:
+        jobs = newest_first(query,
+                            after=request.args.get('after'),
+                            limit=limit + 1)
+    except JobManagerException, error:
+        abort(400, str(error))
+
+    next_cursor = make_cursor(jobs[limit - 1]) if len(jobs) > limit else None
+    jobs = jobs[:limit]
+    data = {'jobs': [_serialize(job, fields, JOB_FIELDS) for job in jobs],
+            'next': next_cursor}
+    etag = _make_etag(request.query_string,
+                      [(job.id, job.last_status, job.last_status_change,
+                        job.remote_job_id) for job in jobs],
+                      next_cursor)
+    return _make_response(data, etag)
+
+
+@api_blueprint.route('/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    """
+    Returns a job. Takes a comma separated `fields' argument.
+    :param job_id:
+    :return:
+    """
+    fields = _get_fields(JOB_FIELDS, JOB_DEFAULT_FIELDS)
+    job = job_services.get_job(job_id)
+    etag = _make_etag(request.query_string,
+                      job.id,
+                      job.last_status,
+                      job.last_status_change,
+                      job.remote_job_id,
+                      job.remote_dir)
+    return _make_response(_serialize(job, fields, JOB_FIELDS), etag)
+
+
+@api_blueprint.route('/jobs/<int:job_id>/files', methods=['GET'])
+@login_required
+def list_files(job_id):
+    """
+    List files of a job. Takes a comma separated `fields' argument and an
+    optional `relation' argument, i.e. input, output, stdout, stderr or
+    script.
+    :param job_id:
+    :return:
+    """
+    fields = _get_fields(FILE_FIELDS, FILE_DEFAULT_FIELDS)
+    relation = request.args.get('relation')
+    if relation is not None:
+        if relation not in FileRelation.__members__:
+            abort(400, 'Unknown relation: %s' % relation)
+        relation = FileRelation[relation]
+
+    files = job_services.list_files(job_id, relation)
+    data = []
+    for staging_file in files:
+        item = _serialize(staging_file, fields, FILE_FIELDS)
+        item['url'] = url_for('jobs.get_file',
+                              job_id=job_id,
+                              file_name=staging_file.name)
+        data.append(item)
+    etag = _make_etag(request.query_string,
+                      [(sf.id, sf.name, sf.checksum, sf.size, sf.modified)
+                       for sf in files])
+    return _make_response({'files': data}, etag)
+
+
+@api_blueprint.route('/jobs/<int:job_id>/output/<any(stdout, stderr):stream>',
+                     methods=['GET'])
+@login_required
+def read_output(job_id, stream):
+    """
+    Returns standard output or error of a job after the given `offset'
+    argument. Poll again with the returned offset to get new output until
+    `finished' is true.
+    :param job_id:
+    :param stream: stdout or stderr
+    :return:
+    """
+    offset = request.args.get('offset', 0, type=int)
+    if offset < 0:
+        abort(400, 'Invalid offset')
+    try:
+        data, offset, finished = \
+            job_services.read_output(job_id, FileRelation[stream], offset)
+    except JobManagerException, error:
+        abort(400, str(error))
+    return jsonify({'data': data.decode('utf-8', 'replace'),
+                    'offset': offset,
+                    'finished': finished})
@@ -0,0 +1,112 @@
+"""
+    sqmpy.job.blobstore
+    ~~~~~
+
+    A content addressed store for staged job files. Each distinct file
+    content is kept once under its checksum and job staging directories hold
+    hard links to it, so jobs sharing the same input files do not cost any
+    extra disk space. The number of links of a blob is its reference count;
+    blobs which are not linked by any job anymore are removed by
+    `collect_garbage'.
+"""
+import os
+import errno
+import shutil
+
+import flask
+
+__author__ = 'Mehdi Sadeghi'
+
+
+def get_blob_store_dir(config=None):
+    """
+    Returns the blob store directory, by default `blobs' in staging directory
+    :param config: application config
+    :return:
+    """
+    if not config:
+        config = flask.current_app.config
+    if config.get('BLOB_STORE_DIR'):
+        return config.get('BLOB_STORE_DIR')
+    staging_dir = config.get('STAGING_DIR', flask.current_app.instance_path)
+    return os.path.join(staging_dir, 'blobs')
+
+
+def get_blob_path(checksum, config=None):
+    """
+    Returns path of the blob with the given checksum
+    :param checksum: file checksum
+    :param config: application config
+    :return:
+    """
+    return os.path.join(get_blob_store_dir(config), checksum[:2], checksum)
+
+
+def add_file(path, checksum, config=None):
+    """
+    Add a staged file to the store. If the content is already stored, the
+    file is replaced by a link to the stored blob, otherwise the file becomes
+    the blob. Files on another file system than the store are left as they
+    are.
+    :param path: path of the staged file
+    :param checksum: file checksum
+    :param config: application config
+    :return: True if the file is linked with the store
+    """
+    if not checksum:
+        return False
+    blob_path = get_blob_path(checksum, config)
+    try:
+        if os.path.exists(blob_path):
+            # Replace the file atomically with a link to the blob
+            tmp_path = path + '.blob'
+            os.link(blob_path, tmp_path)
+            os.rename(tmp_path, path)
+        else:
+            if not os.path.exists(os.path.dirname(blob_path)):
+                os.makedirs(os.path.dirname(blob_path))
+            os.link(path, blob_path)
+        return True
+    except OSError, error:
+        if error.errno not in (errno.EXDEV, errno.EEXIST, errno.EPERM):
+            raise
+        return False
+
+
+def link_file(checksum, src, dst, config=None):
+    """
+    Make the file with the given checksum available at dst without copying
+    it. Falls back to copying src if the content is not in the store.
+    :param checksum: file checksum
+    :param src: path of an existing file with the same content
+    :param dst: destination path
+    :param config: application config
+    :return:
+    """
+    if checksum:
+        blob_path = get_blob_path(checksum, config)
+        try:
+            os.link(blob_path, dst)
+            return
+        except OSError, error:
+            if error.errno not in (errno.ENOENT, errno.EXDEV, errno.EPERM):
+                raise
+    shutil.copy(src, dst)
+    add_file(dst, checksum, config)
+
+
+def collect_garbage(config=None):
+    """
+    Remove blobs which are not linked by any staged file anymore
+    :param config: application config
+    :return: number of removed blobs
+    """
+    removed = 0
+    for root, _, files in os.walk(get_blob_store_dir(config)):
+        for name in files:
+            blob_path = os.path.join(root, name)
+            # The store itself holds one link
+            if os.stat(blob_path).st_nlink <= 1:
+                os.remove(blob_path)
+                removed += 1
+    return removed
@@ -76,16 +76,6 @@ class JobStateChangeCallback(saga.Callback):
             except Exception, ex:
                 current_app.logger.debug(
                     "Callback: Failed to send mail: %s" % ex)
-            # History records are unused for now.
-            # Insert history record
-            # current_app.logger.debug('Callback: adding history record')
-            # history_record = JobStateHistory()
-            # history_record.change_time = datetime.datetime.now()
-            # history_record.old_state = self._job.last_status
-            # history_record.new_state = val
-            # history_record.job_id = self._job.id
-            # db.session.add(history_record)
-
             # If there are new files, transfer them back, along with output
             #   and error files
             current_app.logger.debug('Callback: downloading files')
@@ -98,7 +88,8 @@ class JobStateChangeCallback(saga.Callback):
             # Update last status
             if self._job not in db.session:
                 db.session.merge(self._job)
-            self._job.last_status = val
+            # Update last status and insert history record
+            self._job.set_state(val)
             current_app.logger.debug(
                 'Before commit the new value is %s ' % val)
             db.session.commit()
@@ -19,6 +19,8 @@ class JobStatus(object):
     Represents job states
     """
     INIT = 'Initialization'
+    # Job is staged and waits for background submission
+    SUBMITTING = 'Submitting'
     UNKNOWN = saga.job.UNKNOWN
     NEW = saga.job.NEW
     PENDING = saga.job.PENDING
@@ -29,6 +31,24 @@ class JobStatus(object):
     SUSPENDED = saga.job.SUSPENDED
 
 
+# Remote states after which a job will not be polled anymore
+TERMINAL_STATES = (saga.FAILED,
+                   saga.DONE,
+                   saga.CANCELED,
+                   saga.FINAL,
+                   saga.EXCEPTION)
+
+# States of jobs which are not finished yet, lets queries for unfinished jobs
+# use the index on the last state
+ACTIVE_STATES = (JobStatus.INIT,
+                 JobStatus.SUBMITTING,
+                 JobStatus.UNKNOWN,
+                 JobStatus.NEW,
+                 JobStatus.PENDING,
+                 JobStatus.RUNNING,
+                 JobStatus.SUSPENDED)
+
+
 @unique
 class FileRelation(Enum):
     """
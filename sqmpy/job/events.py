@@ -0,0 +1,163 @@
+"""
+    sqmpy.job.events
+    ~~~~~~~~~~~~~~~~
+
+    In-process publishing of job state changes to subscribers, such as
+    clients of the job event stream.
+"""
+import threading
+from collections import deque
+
+from sqmpy.job.models import Job
+
+__author__ = 'Mehdi Sadeghi'
+
+
+class Subscription(object):
+    """
+    State changes of a set of jobs which one subscriber is interested in.
+    A subscriber waits on its own condition, so idle subscribers cost nothing
+    but memory.
+    """
+
+    def __init__(self, events, states):
+        """
+        :param events: the JobEvents instance
+        :param states: a dict of job ids and states known to the subscriber
+        """
+        self._events = events
+        self._condition = threading.Condition()
+        self._changes = deque()
+        self.states = dict(states)
+
+    @property
+    def job_ids(self):
+        return self.states.keys()
+
+    def put(self, job_id, state):
+        """
+        Deliver a state change, changes to already known states are ignored.
+        """
+        with self._condition:
+            if self.states.get(job_id) == state:
+                return
+            self.states[job_id] = state
+            self._changes.append((job_id, state))
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Wait for state changes.
+        :param timeout: seconds to wait
+        :return: list of (job id, state) tuples, empty on timeout
+        """
+        with self._condition:
+            if not self._changes:
+                self._condition.wait(timeout)
+            changes = list(self._changes)
+            self._changes.clear()
+        return changes
+
+    def close(self):
+        """Stop receiving state changes."""
+        self._events.unsubscribe(self)
+
+
+class JobEvents(object):
+    """
+    Publishes job state changes to subscriptions of the jobs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Subscriptions per job id
+        self._subscriptions = {}
+
+    def subscribe(self, states):
+        """
+        Subscribe to state changes of jobs.
+        :param states: a dict of job ids and their current states
+        :return: Subscription instance
+        """
+        subscription = Subscription(self, states)
+        with self._lock:
+            for job_id in subscription.job_ids:
+                self._subscriptions.setdefault(job_id, set()).add(
+                    subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for job_id in subscription.job_ids:
+                subscriptions = self._subscriptions.get(job_id)
+                if subscriptions is None:
+                    continue
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[job_id]
+
+    def publish(self, job_id, state):
+        """
+        Send a state change to subscribers of the job.
+        :param job_id: job id
+        :param state: new state of the job
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(job_id, ()))
+        for subscription in subscriptions:
+            subscription.put(job_id, state)
+
+    def get_job_ids(self):
+        """
+        Returns ids of jobs which have subscribers
+        """
+        with self._lock:
+            return self._subscriptions.keys()
+
+
+job_events = JobEvents()
+
+
+class JobStatePoller(threading.Thread):
+    """
+    Publishes state changes of subscribed jobs which are made outside of the
+    monitor of this process, e.g. by submissions, cancellations or other
+    processes. States of all subscribed jobs are read from the database at
+    once every EVENTS_POLL_INTERVAL seconds, regardless of the number of
+    subscribers. Changes already published by the monitor are ignored by
+    the subscriptions.
+    """
+
+    def __init__(self, app, *args, **kwargs):
+        """Init."""
+        threading.Thread.__init__(self, *args, **kwargs)
+        self.daemon = True
+        self.app = app
+        self.interval = app.config.get('EVENTS_POLL_INTERVAL', 2)
+        self._closed = threading.Event()
+
+    def close(self):
+        """Stop the poller."""
+        self._closed.set()
+        self.join()
+
+    def run(self):
+        """Run the poller."""
+        while not self._closed.wait(self.interval):
+            job_ids = job_events.get_job_ids()
+            if not job_ids:
+                continue
+            try:
+                self.poll(job_ids)
+            except Exception, error:
+                self.app.logger.exception(
+                    'Failed to poll job states: %s' % error)
+
+    def poll(self, job_ids, chunk_size=500):
+        """Publish current states of the given jobs."""
+        with self.app.app_context():
+            for i in range(0, len(job_ids), chunk_size):
+                for job_id, state in Job.query.filter(
+                        Job.id.in_(job_ids[i:i + chunk_size])).with_entities(
+                        Job.id, Job.last_status):
+                    job_events.publish(job_id, state)
@@ -78,4 +78,7 @@ class JobSubmissionForm(Form):
                          [OptionalIfFieldEqualTo('hpc_backend',
                           HPCBackend.normal.value)])
     description = wtf.TextAreaField('Description', [wtf.validators.Optional()])
+    parameter_sets = \
+        wtf.TextAreaField('Parameter sets, one job per line',
+                          [wtf.validators.Optional()])
     submit = wtf.SubmitField('Submit')
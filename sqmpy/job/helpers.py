@@ -11,22 +11,42 @@ import shutil
 import hashlib
 import smtplib
 import socket
+import urllib
+import tempfile
+import mimetypes
+import threading
 from threading import Thread
+from multiprocessing.pool import ThreadPool
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 import flask
-from flask import url_for
+from flask import url_for, Request, request
 from flask_login import current_user
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.wsgi import FileWrapper, wrap_file
 
 from sqmpy.database import db
 from sqmpy.security import manager as security_services
+from sqmpy.job import blobstore
 from sqmpy.job.exceptions import JobManagerException
 from sqmpy.job.models import Job, StagingFile
 from sqmpy.job.constants import FileRelation, ScriptType
 
+PYBLAKE2_AVAILABLE = True
+try:
+    import pyblake2
+except ImportError:
+    PYBLAKE2_AVAILABLE = False
+
 __author__ = 'Mehdi Sadeghi'
 
+# Shared thread pool to compute checksums in parallel, see
+# `get_file_checksums'
+_checksum_pool = None
+_checksum_pool_lock = threading.Lock()
+
 
 def send_state_change_email(job_id, owner_id, old_state, new_state,
                             mail_config=None, silent=False):
@@ -132,15 +152,21 @@ def is_localhost(host):
     return False
 
 
-def stage_uploaded_files(job, upload_dir, config, silent=False):
+def stage_uploaded_files(job, upload_dir, config, silent=False,
+                         checksums=None):
     """
     Saves files in the given directory under the given job's directory
     :param job:
     :param upload_dir: a directory containing files prefixed with `input_'
         and `script_'
     :param silent: skip empty file names
+    :param checksums: a dict of file names and their already known
+        (checksum, size) tuples, see `save_uploaded_file'
     :return:
     """
+    if checksums is None:
+        checksums = {}
+
     # Get or create job directory
     if not job.staging_dir:
         job.staging_dir = get_job_staging_folder(job.id, config)
@@ -178,10 +204,18 @@ def stage_uploaded_files(job, upload_dir, config, silent=False):
         sf.name = staging_file_name
         sf.relation = staging_file_relation
         sf.original_name = filename
-        sf.checksum = hashlib.md5(open(dst).read()).hexdigest()
+        if filename in checksums:
+            sf.checksum, sf.size = checksums[filename]
+        else:
+            sf.checksum = get_file_checksum(dst, config=config)
+            sf.size = os.path.getsize(dst)
         sf.location = job.staging_dir
         sf.parent_id = job.id
         db.session.add(sf)
+
+        if config.get('BLOB_STORE'):
+            # Keep a single copy of identical files
+            blobstore.add_file(dst, sf.checksum, config)
     # Delete temporary upload directory
     os.removedirs(upload_dir)
     db.session.flush()
@@ -226,3 +260,212 @@ def get_job_staging_folder(job_id, config=None):
     if not os.path.exists(job_path):
         os.makedirs(job_path)
     return job_path
+
+
+def new_checksum(algorithm):
+    """
+    Returns a new hash object for the given algorithm name such as `md5' or
+    `blake2b'. Falls back to pyblake2 for blake2 algorithms if hashlib does
+    not provide them.
+    :param algorithm: name of the hash algorithm
+    :return:
+    """
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        if algorithm in ('blake2b', 'blake2s') and PYBLAKE2_AVAILABLE:
+            return getattr(pyblake2, algorithm)()
+        raise JobManagerException(
+            'Unsupported checksum algorithm: %s' % algorithm)
+
+
+def get_file_checksum(path, algorithm=None, config=None):
+    """
+    Computes checksum of a file. The file is read in chunks of
+    CHECKSUM_CHUNK_SIZE bytes, so memory usage does not depend on file size.
+    :param path: path to the file
+    :param algorithm: hash algorithm, CHECKSUM_ALGORITHM by default
+    :param config: application config
+    :return: hex digest
+    """
+    if not config:
+        config = flask.current_app.config
+    checksum = new_checksum(algorithm or config.get('CHECKSUM_ALGORITHM'))
+    chunk_size = config.get('CHECKSUM_CHUNK_SIZE')
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def get_file_checksums(paths, algorithm=None, config=None):
+    """
+    Computes checksums of many files in parallel using a shared pool of
+    CHECKSUM_WORKERS threads. Blocks until all checksums are computed.
+    :param paths: list of file paths
+    :param algorithm: hash algorithm, CHECKSUM_ALGORITHM by default
+    :param config: application config
+    :return: list of hex digests in the same order as paths
+    """
+    global _checksum_pool
+    if not config:
+        config = flask.current_app.config
+    if len(paths) < 2:
+        return [get_file_checksum(path, algorithm, config) for path in paths]
+    with _checksum_pool_lock:
+        if _checksum_pool is None:
+            _checksum_pool = ThreadPool(config.get('CHECKSUM_WORKERS'))
+    # Pool threads have no application context, so the config is passed on
+    return _checksum_pool.map(
+        lambda path: get_file_checksum(path, algorithm, config), paths)
+
+
+class ChecksumFile(object):
+    """
+    A file like object to receive uploaded files. Data is written into a
+    named temporary file while its checksum and size are computed, so the
+    file does not need to be read again after the upload. The temporary file
+    is removed on close unless it has been moved.
+    """
+
+    def __init__(self, algorithm, directory=None):
+        """
+        Init
+        :param algorithm: hash algorithm
+        :param directory: directory of the temporary file
+        """
+        self._file = tempfile.NamedTemporaryFile(prefix='sqmpy_upload_',
+                                                 dir=directory,
+                                                 delete=False)
+        self._checksum = new_checksum(algorithm)
+        self._moved = False
+        self.name = self._file.name
+        self.size = 0
+
+    def write(self, data):
+        self._checksum.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._checksum.hexdigest()
+
+    def move(self, dst):
+        """
+        Move the received file to the given path
+        """
+        self._file.close()
+        shutil.move(self.name, dst)
+        self._moved = True
+
+    def close(self):
+        self._file.close()
+        if not self._moved and os.path.exists(self.name):
+            os.remove(self.name)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class ChecksumRequest(Request):
+    """
+    Request class which receives uploaded files into `ChecksumFile' streams.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return ChecksumFile(
+            flask.current_app.config.get('CHECKSUM_ALGORITHM'),
+            flask.current_app.config.get('UPLOAD_TEMP_DIR'))
+
+
+def save_uploaded_file(file_storage, dst, config=None):
+    """
+    Save an uploaded file and return its checksum and size. Files received
+    by `ChecksumRequest' are moved without reading them again.
+    :param file_storage: werkzeug FileStorage instance
+    :param dst: destination path
+    :param config: application config
+    :return: (checksum, size) tuple
+    """
+    if isinstance(file_storage.stream, ChecksumFile):
+        file_storage.stream.move(dst)
+        return file_storage.stream.hexdigest(), file_storage.stream.size
+    file_storage.save(dst)
+    return get_file_checksum(dst, config=config), os.path.getsize(dst)
+
+
+def send_staging_file(staging_file, config=None):
+    """
+    Send a staging file in response to the current request. Range and
+    conditional requests are supported, checksum of the file is used as
+    etag. Sending the file content is left to the front server if
+    X_ACCEL_REDIRECT_PREFIX or USE_X_SENDFILE is set, otherwise the file is
+    sent using `wsgi.file_wrapper' of the server, e.g. with sendfile.
+    :param staging_file: StagingFile instance
+    :param config: application config
+    :return: response
+    """
+    config = config or flask.current_app.config
+    path = staging_file.get_path()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        flask.abort(404)
+
+    headers = Headers()
+    data = None
+    redirect_path = _get_x_accel_redirect_path(path, config)
+    if redirect_path:
+        headers['X-Accel-Redirect'] = redirect_path
+    elif config.get('USE_X_SENDFILE'):
+        headers['X-Sendfile'] = path
+    elif request.range:
+        # Ranges are cut from the file by seeking
+        data = FileWrapper(open(path, 'rb'))
+    else:
+        data = wrap_file(request.environ, open(path, 'rb'))
+
+    mimetype = mimetypes.guess_type(staging_file.name)[0] or \
+        'application/octet-stream'
+    response = flask.current_app.response_class(data,
+                                                mimetype=mimetype,
+                                                headers=headers,
+                                                direct_passthrough=True)
+    response.last_modified = int(stat.st_mtime)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.set_etag(staging_file.checksum or '{0}-{1}-{2}'.format(
+        staging_file.id, stat.st_size, int(stat.st_mtime)))
+
+    if data is None:
+        # Ranges are handled by the front server
+        return response.make_conditional(request)
+
+    response.content_length = stat.st_size
+    try:
+        response.make_conditional(request,
+                                  accept_ranges=True,
+                                  complete_length=stat.st_size)
+    except RequestedRangeNotSatisfiable:
+        data.close()
+        raise
+    if response.status_code == 304:
+        data.close()
+    return response
+
+
+def _get_x_accel_redirect_path(path, config):
+    """
+    Returns the internal location of a file for nginx `X-Accel-Redirect'
+    header, or None if X_ACCEL_REDIRECT_PREFIX is not set or the file is not
+    in the staging directory.
+    """
+    prefix = config.get('X_ACCEL_REDIRECT_PREFIX')
+    if not prefix:
+        return None
+    staging_dir = config.get('STAGING_DIR', flask.current_app.instance_path)
+    relative_path = os.path.relpath(path, staging_dir)
+    if relative_path.startswith(os.pardir):
+        return None
+    return '{0}/{1}'.format(prefix.rstrip('/'), urllib.quote(relative_path))
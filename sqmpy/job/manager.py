@@ -8,20 +8,26 @@ import os
 import shutil
 
 import saga
+from sqlalchemy import or_
+from sqlalchemy.orm import defer, joinedload, subqueryload
 from flask import current_app, g, abort
 from flask_login import current_user
 
 from sqmpy.job import constants
 from sqmpy.job import helpers
+from sqmpy.job import blobstore
 from sqmpy.job.exceptions import JobManagerException
 from sqmpy.job.models import Job, Resource, StagingFile
-from sqmpy.job.saga_helper import SagaJobWrapper
+from sqmpy.job.pagination import KeysetPagination, newest_first, count_jobs,\
+    forget_count
+from sqmpy.job.saga_helper import SagaJobWrapper, make_security_context,\
+    submit_jobs, read_job_output
 from sqmpy.database import db
 
 __author__ = 'Mehdi Sadeghi'
 
 
-def submit(resource_url, upload_dir, script_type, **kwargs):
+def submit(resource_url, upload_dir, script_type, checksums=None, **kwargs):
     """
     Submit a new job along with its input files. Input files will be moved
     under a new folder with this structure:
@@ -32,6 +38,8 @@ def submit(resource_url, upload_dir, script_type, **kwargs):
         be considered as input and script file respectively.
     :param script_type: a value from ScriptType enum to represend script type.
         could be 0 for shell and 1 for python scripts.
+    :param checksums: a dict of uploaded file names and their (checksum, size)
+        tuples, if they are already known.
     :param kwargs::
         :param hpc_backend: type of scheduler on the remote host. Currently
             normal(shell) and sge are supported.
@@ -50,30 +58,11 @@ def submit(resource_url, upload_dir, script_type, **kwargs):
         raise JobManagerException('At least script files should be uploaded')
 
     # Create a job and fill it with provided information
-    job = Job()
-    job.owner_id = current_user.id
-    job.script_type = constants.ScriptType(script_type).value
-
-    if 'hpc_backend' in kwargs:
-        job.hpc_backend = constants.HPCBackend(kwargs.get('hpc_backend')).value
-
+    job = _make_job(script_type, **kwargs)
     job.remote_dir = kwargs.get('working_directory')
-    job.description = kwargs.get('description')
-    job.total_cpu_count = kwargs.get('total_cpu_count')
-    job.walltime_limit = kwargs.get('walltime_limit')
-    job.spmd_variation = kwargs.get('spmd_variation')
-    job.queue = kwargs.get('queue')
-    job.project = kwargs.get('project')
-    job.total_physical_memory = kwargs.get('total_physical_memory')
 
     try:
-        # Insert a new record for url if it does not exist already
-        resource = Resource.query.filter(Resource.url == resource_url).first()
-        if not resource:
-            resource = Resource(resource_url)
-            db.session.add(resource)
-            db.session.flush()
-        job.resource_id = resource.id
+        job.resource_id = _get_or_create_resource(resource_url).id
         db.session.add(job)
         db.session.flush()
 
@@ -85,11 +74,11 @@ def submit(resource_url, upload_dir, script_type, **kwargs):
         helpers.stage_uploaded_files(job,
                                      upload_dir,
                                      current_app.config,
-                                     silent=True)
+                                     silent=True,
+                                     checksums=checksums)
 
         # Submit the job using saga
-        saga_wrapper = SagaJobWrapper(job)
-        saga_wrapper.run()
+        _run_jobs([job])
     except saga.exceptions.AuthenticationFailed, error:
         db.session.rollback()
         raise JobManagerException('Can not login to the remote host, \
@@ -102,6 +91,128 @@ def submit(resource_url, upload_dir, script_type, **kwargs):
     return job.id
 
 
+def submit_bulk(resource_url, upload_dir, script_type, parameter_sets,
+                checksums=None, **kwargs):
+    """
+    Submit a parameter sweep, i.e. one job per parameter set, all sharing the
+    same script and input files. Jobs are created in one transaction, files
+    are staged once and uploaded once to the resource.
+    :param resource_url: resource to submit jobs there
+    :param upload_dir: a temp directory which contains uploaded files, see
+        `submit'
+    :param script_type: a value from ScriptType enum
+    :param parameter_sets: list of command line argument strings, one per job
+    :param checksums: a dict of uploaded file names and their (checksum, size)
+        tuples, if they are already known.
+    :param kwargs: job options, see `submit'. If working_directory is given,
+        every job will run in a sub directory named after job id.
+    :return: list of job ids
+    """
+    # Basic checks
+    if not resource_url:
+        raise JobManagerException("Resource is not defined.")
+
+    if not upload_dir:
+        raise JobManagerException('At least script files should be uploaded')
+
+    if not parameter_sets:
+        raise JobManagerException('No parameter sets are given.')
+
+    try:
+        resource = _get_or_create_resource(resource_url)
+        jobs = []
+        for index, parameters in enumerate(parameter_sets):
+            job = _make_job(script_type, **kwargs)
+            job.resource_id = resource.id
+            job.arguments = parameters
+            if job.description:
+                job.description = '{description} [{index}/{count}]'.format(
+                    description=job.description,
+                    index=index + 1,
+                    count=len(parameter_sets))
+            db.session.add(job)
+            jobs.append(job)
+        db.session.flush()
+
+        first_job = jobs[0]
+        helpers.stage_uploaded_files(first_job,
+                                     upload_dir,
+                                     current_app.config,
+                                     silent=True,
+                                     checksums=checksums)
+        shared_files = StagingFile.query.filter(
+            StagingFile.parent_id == first_job.id).all()
+        working_directory = kwargs.get('working_directory')
+        for job in jobs:
+            if working_directory:
+                job.remote_dir = os.path.join(working_directory, str(job.id))
+            if job is first_job:
+                continue
+            job.script = first_job.script
+            job.staging_dir = helpers.get_job_staging_folder(job.id)
+            # Files are not copied, records point to the first job's files
+            for sf in shared_files:
+                new_sf = StagingFile()
+                new_sf.name = sf.name
+                new_sf.original_name = sf.original_name
+                new_sf.location = sf.location
+                new_sf.relative_path = sf.relative_path
+                new_sf.relation = sf.relation
+                new_sf.checksum = sf.checksum
+                new_sf.size = sf.size
+                new_sf.parent_id = job.id
+                db.session.add(new_sf)
+        db.session.flush()
+
+        # Submit the jobs using saga
+        _run_jobs(jobs)
+    except saga.exceptions.AuthenticationFailed, error:
+        db.session.rollback()
+        raise JobManagerException('Can not login to the remote host, \
+            authentication failed. %s' % error)
+    except Exception:
+        db.session.rollback()
+        raise
+    # If no error has happened so far, commit the session.
+    db.session.commit()
+    return [job.id for job in jobs]
+
+
+def _make_job(script_type, **kwargs):
+    """
+    Create a job of the current user and fill it with the given options,
+    see `submit'.
+    """
+    job = Job()
+    job.owner_id = current_user.id
+    job.script_type = constants.ScriptType(script_type).value
+
+    if 'hpc_backend' in kwargs:
+        job.hpc_backend = constants.HPCBackend(kwargs.get('hpc_backend')).value
+
+    job.description = kwargs.get('description')
+    job.total_cpu_count = kwargs.get('total_cpu_count')
+    job.walltime_limit = kwargs.get('walltime_limit')
+    job.spmd_variation = kwargs.get('spmd_variation')
+    job.queue = kwargs.get('queue')
+    job.project = kwargs.get('project')
+    job.total_physical_memory = kwargs.get('total_physical_memory')
+    return job
+
+
+def _get_or_create_resource(resource_url):
+    """
+    Returns the resource with the given url, inserts a new record for url if
+    it does not exist already.
+    """
+    resource = Resource.query.filter(Resource.url == resource_url).first()
+    if not resource:
+        resource = Resource(resource_url)
+        db.session.add(resource)
+        db.session.flush()
+    return resource
+
+
 def resubmit(job_id):
     """
     Create a new job and submit it using the given job as template.
@@ -112,6 +223,7 @@ def resubmit(job_id):
     job.owner_id = current_user.id
     job.script = template_job.script
     job.script_type = template_job.script_type
+    job.arguments = template_job.arguments
     job.description = template_job.description
     job.total_cpu_count = template_job.total_cpu_count
     job.walltime_limit = template_job.walltime_limit
@@ -138,7 +250,11 @@ def resubmit(job_id):
                     dst = os.path.join(job.staging_dir,
                                        sf.relative_path,
                                        sf.name)
-                shutil.copy(src, dst)
+                if current_app.config.get('BLOB_STORE'):
+                    # Link the stored content instead of copying
+                    blobstore.link_file(sf.checksum, src, dst)
+                else:
+                    shutil.copy(src, dst)
 
                 # Create a new record for newly copied file
                 new_sf = StagingFile()
@@ -148,14 +264,14 @@ def resubmit(job_id):
                 new_sf.relative_path = sf.relative_path
                 new_sf.relation = sf.relation
                 new_sf.checksum = sf.checksum
+                new_sf.size = sf.size
                 new_sf.parent_id = job.id
 
                 db.session.add(new_sf)
                 db.session.flush()
 
         # Submit the job using saga
-        saga_wrapper = SagaJobWrapper(job)
-        saga_wrapper.run()
+        _run_jobs([job])
     except saga.exceptions.AuthenticationFailed, error:
         db.session.rollback()
         raise JobManagerException('Can not login to the remote host, \
@@ -168,6 +284,26 @@ def resubmit(job_id):
     return job.id
 
 
+def _run_jobs(jobs):
+    """
+    Submit staged jobs to their resource. If ASYNC_SUBMISSION is set, jobs
+    are committed in SUBMITTING state and submitted by the background
+    submission pool, otherwise they are submitted right away. More than one
+    job are expected to share files, see `submit_bulk'.
+    :param jobs: list of job instances
+    """
+    # Security context has to be made within the request
+    context = make_security_context()
+    forget_count(jobs[0].owner_id)
+    if current_app.config.get('ASYNC_SUBMISSION'):
+        for job in jobs:
+            job.set_state(constants.JobStatus.SUBMITTING)
+        db.session.commit()
+        current_app.submitter.send(([job.id for job in jobs], context))
+    else:
+        submit_jobs(jobs, context)
+
+
 def get_job_status(job_id):
     """
     Get job updated status
@@ -192,6 +328,21 @@ def get_job_status(job_id):
     return job.last_status
 
 
+def get_job_statuses(job_ids, chunk_size=500):
+    """
+    Get last known status of many jobs at once. Jobs which do not exist or
+    which the current user has no access to are left out.
+    :param job_ids: list of job ids
+    :param chunk_size: maximum number of job ids per query
+    :return: a dict of job ids and states
+    """
+    states = {}
+    for i in range(0, len(job_ids), chunk_size):
+        query = filter_jobs().filter(Job.id.in_(job_ids[i:i + chunk_size]))
+        states.update(query.with_entities(Job.id, Job.last_status))
+    return states
+
+
 def _check_access(job):
     """
     Check if current user has access to the given job
@@ -214,12 +365,18 @@ def _check_file_access(file_id):
     _check_access(job)
 
 
-def get_job(job_id, *args, **kwargs):
+def get_job(job_id, with_files=False, *args, **kwargs):
     """
     Get a job
     :job_id: id of the job
+    :with_files: load resource and files of the job along with it
     """
-    job = Job.query.get(job_id)
+    query = Job.query
+    if with_files:
+        # Avoid one query per file when rendering the job
+        query = query.options(joinedload(Job.resource),
+                              subqueryload(Job.files))
+    job = query.get(job_id)
 
     if not job:
         abort(404)
@@ -230,22 +387,104 @@ def get_job(job_id, *args, **kwargs):
     return job
 
 
-def list_jobs(page=None, **kwargs):
+def list_jobs(page=None, after=None, before=None, **kwargs):
     """
-    List submitted jobs.
+    List submitted jobs, newest first. Pages are selected by cursors of
+    neighbour pages if given, otherwise by page number.
     :param page: page number
+    :param after: cursor of the last job of previous page
+    :param before: cursor of the first job of next page
     :return: job pagination
     """
+    page = page or 1
+    per_page = current_app.config['PER_PAGE']
 
+    query = filter_jobs()
+    owner_id = _get_owner_id()
+    # Job list does not show scripts, no need to load them
+    query = query.options(defer(Job.script), defer(Job.resource_endpoint))
+
+    total = count_jobs(query,
+                       owner_id,
+                       current_app.config.get('JOB_COUNT_CACHE_TIMEOUT'))
+
+    # Fetch one more job to find out if there are more pages
+    if after or before:
+        jobs = newest_first(query, after, before, per_page + 1)
+    else:
+        # Old style page urls, falls back to offset
+        jobs = newest_first(query,
+                            limit=per_page + 1,
+                            offset=(page - 1) * per_page)
+
+    if before:
+        has_prev = len(jobs) > per_page
+        has_next = True
+        jobs = jobs[-per_page:]
+    else:
+        has_prev = page > 1 or after is not None
+        has_next = len(jobs) > per_page
+        jobs = jobs[:per_page]
+    return KeysetPagination(page, per_page, jobs, has_prev, has_next, total)
+
+
+def _get_owner_id():
+    """
+    Returns id of the current user, None if login is disabled and all jobs
+    are visible.
+    """
     if current_user.is_anonymous and current_app.config.get('LOGIN_DISABLED'):
         # Do not filter. Login is disabled.
-        query = Job.query.filter().order_by(Job.submit_date.desc())
-    else:
-        query = \
-            Job.query.filter(Job.owner_id == current_user.id).order_by(
-                Job.submit_date.desc())
+        return None
+    return current_user.id
 
-    return query.paginate(page, current_app.config['PER_PAGE'])
+
+def filter_jobs(last_status=None, resource=None):
+    """
+    Returns a query of jobs of the current user.
+    :param last_status: only select jobs in this state
+    :param resource: only select jobs of the resource with this url or name
+    :return: job query
+    """
+    query = Job.query
+    owner_id = _get_owner_id()
+    if owner_id is not None:
+        query = query.filter(Job.owner_id == owner_id)
+    if last_status:
+        query = query.filter(Job.last_status == last_status)
+    if resource:
+        query = query.join(Resource).filter(
+            or_(Resource.url == resource, Resource.name == resource))
+    return query
+
+
+def list_files(job_id, relation=None):
+    """
+    List files of a job.
+    :param job_id: id of the job
+    :param relation: only select files with this FileRelation
+    :return: list of staging files
+    """
+    # Check access
+    job = get_job(job_id)
+    query = StagingFile.query.filter(StagingFile.parent_id == job.id)
+    if relation is not None:
+        query = query.filter(StagingFile.relation == relation.value)
+    return query.order_by(StagingFile.id).all()
+
+
+def read_output(job_id, relation, offset=0):
+    """
+    Read standard output or error of a job from the given offset, see
+    saga_helper.read_job_output.
+    :param job_id: id of the job
+    :param relation: FileRelation.stdout or FileRelation.stderr
+    :param offset: number of bytes the reader already has
+    :return: (data, offset after data, finished) tuple
+    """
+    # Check access
+    get_job(job_id)
+    return read_job_output(job_id, relation, offset)
 
 
 def get_file(file_id):
@@ -266,15 +505,16 @@ def get_file_by_name(job_id, file_name):
     :param file_name:
     :return:
     """
-    # Find the job
+    # Find the job, this checks access as well
     job = get_job(job_id)
 
-    for staging_file in job.files:
-        if staging_file.name == file_name:
-            return staging_file
-
-    # If nothing sofar
-    abort(404)
+    # Query the file directly instead of loading all files of the job
+    staging_file = StagingFile.query.filter(
+        StagingFile.parent_id == job.id,
+        StagingFile.name == file_name).order_by(StagingFile.id).first()
+    if staging_file is None:
+        abort(404)
+    return staging_file
 
 
 def cancel_job(job_id):
@@ -285,4 +525,7 @@ def cancel_job(job_id):
     """
     job = get_job(job_id)
     wrapper = SagaJobWrapper(job)
-    wrapper.cancel()
+    try:
+        wrapper.cancel()
+    finally:
+        wrapper.close()
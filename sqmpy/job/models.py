@@ -18,9 +18,17 @@ class Job(db.Model):
     A job represents a task submitted by user to a remote resource.
     """
     __tablename__ = 'jobs'
+    __table_args__ = (
+        # Listing jobs of a user ordered by submit date
+        db.Index('ix_jobs_owner_id_submit_date', 'owner_id', 'submit_date'),
+        # Finding unfinished jobs
+        db.Index('ix_jobs_last_status', 'last_status'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     submit_date = db.Column(db.DateTime)
     last_status = db.Column(db.String(50))
+    # Time of the last state change, see set_state
+    last_status_change = db.Column(db.DateTime)
     # Currently this would be the id generated by saga for the job such as
     # '[fork://localhost]-[17856.0]'
     remote_job_id = db.Column(db.String(50))
@@ -29,6 +37,8 @@ class Job(db.Model):
     resource_endpoint = db.Column(db.Text())
     script = db.Column(db.Text())
     script_type = db.Column(db.Integer, nullable=False)
+    # Command line arguments of the script, e.g. parameters of a sweep task
+    arguments = db.Column(db.Text())
     hpc_backend = db.Column(db.Integer)
     description = db.Column(db.Text())
 
@@ -42,10 +52,33 @@ class Job(db.Model):
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     resource_id = db.Column(db.Integer, db.ForeignKey('resources.id'))
     files = db.relationship('StagingFile')
+    state_history = db.relationship('JobStateHistory',
+                                    order_by='JobStateHistory.change_time')
 
     def __init__(self):
         self.submit_date = datetime.datetime.utcnow()
-        self.last_status = JobStatus.INIT
+        self.last_status = None
+        self.set_state(JobStatus.INIT, self.submit_date)
+
+    def set_state(self, new_state, change_time=None):
+        """
+        Change state of the job and record the change in its history
+        :param new_state: new state of the job
+        :param change_time: time of the change, defaults to now
+        """
+        record = JobStateHistory(
+            old_state=self.last_status,
+            new_state=new_state,
+            change_time=change_time or datetime.datetime.utcnow())
+        if self.id is not None and \
+                'state_history' in db.inspect(self).unloaded:
+            # Do not load the whole history of a stored job to add a record
+            record.job_id = self.id
+            (db.object_session(self) or db.session).add(record)
+        else:
+            self.state_history.append(record)
+        self.last_status = new_state
+        self.last_status_change = record.change_time
 
     def __repr__(self):
         return '<Job %s>' % self.id
@@ -77,6 +110,12 @@ class StagingFile(db.Model):
     This entity will keep track of files for each job, either input or output.
     """
     __tablename__ = 'stagingfiles'
+    __table_args__ = (
+        # Finding files of a job by relation or by name
+        db.Index('ix_stagingfiles_parent_id_relation', 'parent_id',
+                 'relation'),
+        db.Index('ix_stagingfiles_parent_id_name', 'parent_id', 'name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50))
     original_name = db.Column(db.String(50))
@@ -84,6 +123,10 @@ class StagingFile(db.Model):
     location = db.Column(db.String(150), nullable=False)
     relative_path = db.Column(db.String(150), nullable=True)
     checksum = db.Column(db.String)
+    # Size of the file, for downloaded files size and modification time
+    # (as unix timestamp) are those of the remote file at last download
+    size = db.Column(db.BigInteger)
+    modified = db.Column(db.Float)
     parent_id = db.Column(db.Integer, db.ForeignKey('jobs.id'))
 
     def get_path(self):
@@ -104,6 +147,28 @@ class StagingFile(db.Model):
         return '<File %s>' % self.name
 
 
+class RemoteCacheEntry(db.Model):
+    """
+    A file which is cached on a resource under its checksum, so that it can
+    be copied there instead of being uploaded again. Files are cached in the
+    home directory of the remote user.
+    """
+    __tablename__ = 'remotecache'
+    __table_args__ = (
+        db.Index('ix_remotecache_resource_id_remote_user_checksum',
+                 'resource_id', 'remote_user', 'checksum'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    resource_id = db.Column(db.Integer, db.ForeignKey('resources.id'))
+    remote_user = db.Column(db.String(100))
+    checksum = db.Column(db.String(128), nullable=False)
+    path = db.Column(db.String(250), nullable=False)
+    last_used = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<Cached file %s>' % self.path
+
+
 class JobStateHistory(db.Model):
     """
     Record of changes in job state
@@ -115,7 +180,7 @@ class JobStateHistory(db.Model):
     change_time = db.Column(db.DateTime)
     old_state = db.Column(db.String(50))
     new_state = db.Column(db.String(50))
-    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id'))
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id'), index=True)
 
     def __repr__(self):
         return '<State from %s to %s>' % (self.old_state, self.new_state)
@@ -1,95 +1,740 @@
 """Job monitoring stuff."""
+import os
+import glob
+import json
 import time
+import fcntl
+import heapq
+import datetime
+import itertools
 import threading
-from Queue import Queue
+from Queue import Queue, Empty
+from collections import OrderedDict
 
 import saga
-from flask_sqlalchemy import SQLAlchemy
 
+from sqmpy.database import db
+from sqmpy.job.constants import ACTIVE_STATES, TERMINAL_STATES
+from sqmpy.job.events import job_events
 from sqmpy.job.helpers import send_state_change_email
-from sqmpy.job.models import StagingFile, Job
-from sqmpy.job.saga_helper import download_job_files
+from sqmpy.job.models import StagingFile, Job, JobStateHistory
+from sqmpy.job.saga_helper import download_job_files, get_job_states,\
+    get_service_key, job_service_pool, release_job_endpoint, uses_login_info
 
 
 class JobMonitorThread(threading.Thread):
-    """Job monitoring thread."""
+    """
+    Job monitoring thread.
+
+    Monitored jobs are kept in a schedule ordered by the time their next poll
+    is due. The thread sleeps until the earliest job is due and hands all due
+    jobs over to a pool of worker threads, which poll them and schedule them
+    again according to the poll interval of their current state. Due jobs on
+    the same resource are polled in one batch. The number of batches being
+    processed at the same time for one resource is limited, so that a slow
+    resource can not occupy all workers.
+
+    Jobs are not persisted by the monitor itself, unfinished jobs are found
+    in the database and scheduled again when the monitor starts. Only one
+    monitor per host polls jobs, the one holding the monitor lock. Other
+    monitors wait for the lock and ignore jobs sent to them, the leader finds
+    those jobs in the database.
+
+    Jobs found in the database are polled using ssh keys, since login
+    information of users is not shared between processes. If users connect
+    to resources with their login information, see SSH_WITH_LOGIN_INFO, every
+    monitor polls the jobs sent to it instead and no leader is elected.
+    """
 
     def __init__(self, *args, **kwargs):
         """Init."""
         threading.Thread.__init__(self, *args, **kwargs)
         self.app = kwargs.get('kwargs').get('app')
-        self.input_queue = Queue()
-        self.db = SQLAlchemy()
-        self.db.init_app(self.app)
+        # State changes are written by one thread
+        self.writer = StateWriter(self.app, name='sqmpy-monitor-writer')
+        # A heap of (due time, sequence, job id, endpoint, security context)
+        # entries. The sequence number keeps entries with the same due time
+        # in order.
+        self._schedule = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        # Ids of jobs which are being monitored
+        self._monitored = set()
+        # Ids of recently finished jobs, their state may not be written yet
+        self._finished = OrderedDict()
+        self.is_leader = False
+        # Find jobs in the database only if they can be polled with ssh keys
+        self.discovery = not uses_login_info(self.app.config)
+        self.lock = MonitorLock(get_monitor_lock_file(self.app))
+        self.lock_retry_interval = \
+            self.app.config.get('MONITOR_LOCK_RETRY_INTERVAL', 10)
+        self.discovery_interval = \
+            self.app.config.get('MONITOR_DISCOVERY_INTERVAL', 5)
+        self.recovery_rate = \
+            self.app.config.get('MONITOR_RECOVERY_RATE', 100)
+        self.poll_intervals = \
+            self.app.config.get('MONITOR_POLL_INTERVALS', {})
+        self.default_poll_interval = \
+            self.app.config.get('MONITOR_DEFAULT_POLL_INTERVAL', 10)
+        self.batch_polling = \
+            self.app.config.get('MONITOR_BATCH_POLLING', True)
+        self.sync_interval = \
+            self.app.config.get('MONITOR_SYNC_INTERVAL', 0)
+        self.stats_interval = \
+            self.app.config.get('MONITOR_STATS_INTERVAL', 10)
+        # Last time output files were synced per job id
+        self._last_sync = {}
+        self.max_workers_per_resource = \
+            self.app.config.get('MONITOR_MAX_WORKERS_PER_RESOURCE', 2)
+        # Batches of (service key, endpoint, context, job ids) to be processed
+        self._work_queue = Queue()
+        # Number of batches being processed per resource endpoint, shared by
+        # all users of the resource
+        self._active = {}
+        # Batches waiting for a free slot per resource endpoint
+        self._deferred = {}
+        self._lock = threading.Lock()
+        self.workers = \
+            [MonitorWorker(self, name='sqmpy-monitor-worker-%s' % i)
+             for i in range(self.app.config.get('MONITOR_WORKERS', 4))]
+
+    def send(self, item, delay=0):
+        """
+        Send a job to monitor.
+        :param item: a tuple of job id, resource endpoint and saga security
+            context to connect to the resource
+        :param delay: seconds to wait before the first poll
+        """
+        job_id, endpoint, context = item
+        with self._condition:
+            if job_id in self._monitored:
+                return
+            if self.discovery and not self.is_leader:
+                # The leader will find the job in the database
+                return
+            self._monitored.add(job_id)
+        self._schedule_job(job_id, endpoint, context, time.time() + delay)
 
-    def send(self, item):
-        """Send a job to monitor."""
-        self.input_queue.put(item)
+    def recover(self):
+        """
+        Schedule unfinished jobs found in the database, e.g. jobs which were
+        being monitored before a restart or jobs which were submitted through
+        other processes. Jobs of the same resource are scheduled next to each
+        other, so they are polled in batches.
+        :return: number of scheduled jobs
+        """
+        with self.app.app_context():
+            jobs = db.session.query(Job.id, Job.resource_endpoint).filter(
+                Job.remote_job_id.isnot(None),
+                Job.last_status.in_(ACTIVE_STATES)).order_by(
+                Job.resource_endpoint, Job.id).all()
+            # Login information is not available, use ssh keys
+            context = saga.Context('ssh')
+        with self._condition:
+            jobs = [(job_id, endpoint) for job_id, endpoint in jobs
+                    if job_id not in self._monitored and
+                    job_id not in self._finished]
+        count = 0
+        for job_id, endpoint in jobs:
+            # Do not poll more than recovery_rate jobs per second
+            delay = float(count) / self.recovery_rate \
+                if self.recovery_rate else 0
+            self.send((job_id, endpoint, context), delay)
+            count += 1
+        return count
+
+    def start(self):
+        """Start the workers and the monitor thread."""
+        self.writer.start()
+        for worker in self.workers:
+            worker.start()
+        threading.Thread.start(self)
 
     def close(self):
-        """Close the monitor thread."""
-        self.input_queue.put(None)
-        self.input_queue.join()
+        """Close the monitor thread and its workers."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self.ident is None:
+            # Monitor was never started
+            return
+        self.join()
+        for worker in self.workers:
+            self._work_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.writer.close()
+        self.remove_stats()
+        self.lock.release()
+
+    def get_stats(self):
+        """
+        Returns a dict of statistics about monitor load, i.e. the number of
+        scheduled, due and queued jobs and utilisation of every worker.
+        """
+        now = time.time()
+        with self._condition:
+            scheduled = len(self._schedule)
+            due = len([entry for entry in self._schedule if entry[0] <= now])
+        with self._lock:
+            active = dict((endpoint, count)
+                          for endpoint, count in self._active.iteritems()
+                          if count)
+            deferred = sum(len(job_ids)
+                           for batches in self._deferred.itervalues()
+                           for _, _, _, job_ids in batches)
+        return {'pid': os.getpid(),
+                'leader': self.is_leader,
+                'scheduled_jobs': scheduled,
+                'due_jobs': due,
+                'queued_batches': self._work_queue.qsize(),
+                'deferred_jobs': deferred,
+                'active_batches': active,
+                'queued_state_writes': self.writer._queue.qsize(),
+                'workers': [worker.get_stats() for worker in self.workers]}
+
+    def write_stats(self):
+        """
+        Write statistics of this monitor to its stats file, so that they can
+        be read by every process.
+        """
+        path = get_monitor_stats_file(self.app, os.getpid())
+        try:
+            with open(path + '.tmp', 'w') as stats_file:
+                json.dump(self.get_stats(), stats_file)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError), error:
+            self.app.logger.error('Failed to write monitor stats: %s' % error)
+
+    def remove_stats(self):
+        """Remove the stats file of this monitor."""
+        try:
+            os.unlink(get_monitor_stats_file(self.app, os.getpid()))
+        except OSError:
+            pass
+
+    def get_poll_interval(self, state):
+        """
+        Returns number of seconds to wait before polling a job in the given
+        state again.
+        """
+        return self.poll_intervals.get(state, self.default_poll_interval)
+
+    def _schedule_job(self, job_id, endpoint, context, due):
+        """Add a job to the schedule and wake up the monitor thread."""
+        with self._condition:
+            heapq.heappush(self._schedule,
+                           (due, next(self._sequence), job_id, endpoint,
+                            context))
+            self._condition.notify()
+
+    def _pop_due(self, deadline=None):
+        """
+        Block until at least one scheduled job is due or the given deadline
+        is reached and return all due entries. Returns None once the monitor
+        is closed.
+        """
+        with self._condition:
+            while not self._closed:
+                wait_time = deadline - time.time() \
+                    if deadline is not None else None
+                if self._schedule:
+                    due_time = self._schedule[0][0] - time.time()
+                    if wait_time is None or due_time < wait_time:
+                        wait_time = due_time
+                if wait_time is None:
+                    self._condition.wait()
+                    continue
+                if wait_time > 0:
+                    self._condition.wait(wait_time)
+                    continue
+                now = time.time()
+                entries = []
+                while self._schedule and self._schedule[0][0] <= now:
+                    entries.append(heapq.heappop(self._schedule))
+                return entries
+        return None
+
+    def _group_entries(self, entries):
+        """
+        Group due entries by job service. In batch mode jobs sharing the same
+        resource endpoint and security context are polled together, otherwise
+        every job makes its own group.
+        :return: list of (service key, endpoint, context, job ids) tuples
+        """
+        groups = []
+        batches = OrderedDict()
+        for _, _, job_id, endpoint, context in entries:
+            key = get_service_key(endpoint, context)
+            if not self.batch_polling:
+                groups.append((key, endpoint, context, [job_id]))
+            elif key in batches:
+                batches[key][3].append(job_id)
+            else:
+                batches[key] = (key, endpoint, context, [job_id])
+        return groups + batches.values()
+
+    def _dispatch(self, key, endpoint, context, job_ids):
+        """
+        Hand a batch of jobs over to the workers. If the resource has already
+        reached its limit of concurrent batches, no matter which users they
+        belong to, the batch is deferred until one of them is finished.
+        """
+        with self._lock:
+            if self._active.get(endpoint, 0) >= \
+                    self.max_workers_per_resource:
+                self._deferred.setdefault(endpoint, []).append(
+                    (key, endpoint, context, job_ids))
+                return
+            self._active[endpoint] = self._active.get(endpoint, 0) + 1
+        self._work_queue.put((key, endpoint, context, job_ids))
+
+    def _finish(self, endpoint):
+        """
+        Release the resource slot of a processed batch and dispatch the
+        batches deferred for the same resource.
+        """
+        with self._lock:
+            self._active[endpoint] -= 1
+            batches = self._deferred.pop(endpoint, [])
+        if self.batch_polling and batches:
+            # Deferred batches of the same job service can be polled together
+            merged = OrderedDict()
+            for key, _, context, job_ids in batches:
+                if key in merged:
+                    merged[key][3].extend(job_ids)
+                else:
+                    merged[key] = (key, endpoint, context, list(job_ids))
+            batches = merged.values()
+        for key, _, context, job_ids in batches:
+            self._dispatch(key, endpoint, context, job_ids)
+
+    def _wait_for_leadership(self):
+        """
+        Block until this monitor holds the monitor lock.
+        :return: False if the monitor was closed meanwhile
+        """
+        with self._condition:
+            while not self._closed:
+                if self.lock.acquire():
+                    self.is_leader = True
+                    return True
+                self._condition.wait(self.lock_retry_interval)
+        return False
+
+    def _discover(self):
+        """Schedule unfinished jobs which are not monitored yet."""
+        try:
+            count = self.recover()
+            if count:
+                self.app.logger.info('Found %s unfinished jobs.' % count)
+        except Exception, error:
+            self.app.logger.exception(
+                'Failed to find unfinished jobs: %s' % error)
 
     def run(self):
         """Run the monitor thread."""
+        discovery_interval = self.discovery_interval
+        if self.discovery:
+            if not self._wait_for_leadership():
+                return
+            self.app.logger.info('Monitor %s is the leader.' % os.getpid())
+        else:
+            # Every monitor polls the jobs sent to it
+            discovery_interval = None
+        next_discovery = time.time()
+        next_stats = time.time()
         while True:
-            job_id, job_service, = self.input_queue.get()
-            if job_id is None:
+            if discovery_interval and time.time() >= next_discovery:
+                self._discover()
+                next_discovery = time.time() + discovery_interval
+            if self.stats_interval and time.time() >= next_stats:
+                self.write_stats()
+                next_stats = time.time() + self.stats_interval
+            deadlines = [deadline for deadline, interval in
+                         ((next_discovery, discovery_interval),
+                          (next_stats, self.stats_interval)) if interval]
+            entries = self._pop_due(min(deadlines) if deadlines else None)
+            if entries is None:
                 break
-            # Process the job
-            with self.app.app_context():
-                self.process(job_id, job_service)
-            self.input_queue.task_done()
-            time.sleep(1)
+            for key, endpoint, context, job_ids in \
+                    self._group_entries(entries):
+                self._dispatch(key, endpoint, context, job_ids)
         # Done
-        self.input_queue.task_done()
         return
 
-    def process(self, job_id, job_service):
-        """Process job state changes."""
+    def poll(self, endpoint, context, job_ids):
+        """
+        Poll a batch of jobs and schedule the next poll of the jobs which are
+        still running. This is called by workers.
+        """
+        with self.app.app_context():
+            try:
+                job_service = job_service_pool.get(endpoint, context)
+                try:
+                    states = self.process_batch(job_service, job_ids)
+                finally:
+                    job_service_pool.put(job_service)
+            except Exception, error:
+                self.app.logger.exception(
+                    'Failed to monitor jobs %s: %s' % (job_ids, error))
+                states = {}
+        now = time.time()
+        for job_id in job_ids:
+            state = states.get(job_id)
+            if state in TERMINAL_STATES:
+                with self._condition:
+                    self._monitored.discard(job_id)
+                    self._finished[job_id] = now
+                    self._forget_finished(now)
+            else:
+                self._schedule_job(job_id,
+                                   endpoint,
+                                   context,
+                                   now + self.get_poll_interval(state))
+
+    def _forget_finished(self, now):
+        """
+        Forget finished jobs whose final state has been written by now, so
+        that discovery will not schedule them again. Should be called while
+        holding the condition.
+        """
+        expiry = now - 10 * max(self.discovery_interval, 1)
+        for job_id, finished_at in self._finished.items():
+            if finished_at >= expiry:
+                break
+            del self._finished[job_id]
+
+    def process_batch(self, job_service, job_ids):
+        """
+        Process state changes of jobs which are running on the same job
+        service. States of all jobs are queried at once.
+        :return: a dict of job ids and their remote states
+        """
+        states = {}
+        remote_states = {}
+        # State changes of the batch are written in one transaction
+        changes = []
+        jobs = Job.query.filter(Job.id.in_(job_ids)).all()
+        if len(jobs) > 1:
+            try:
+                remote_states = \
+                    get_job_states(job_service,
+                                   [job.remote_job_id for job in jobs])
+            except Exception, error:
+                # Fall back to polling the jobs one by one
+                self.app.logger.exception(
+                    'Failed to query states of jobs %s: %s' % (job_ids, error))
+        for job in jobs:
+            try:
+                states[job.id] = \
+                    self.process(job.id,
+                                 job_service,
+                                 remote_states.get(job.remote_job_id),
+                                 changes)
+            except Exception, error:
+                self.app.logger.exception(
+                    'Failed to monitor job %s: %s' % (job.id, error))
+        if changes:
+            self.writer.send(changes)
+        return states
+
+    def process(self, job_id, job_service, remote_job_state=None,
+                changes=None):
+        """
+        Process job state changes.
+        :param job_id: local job id
+        :param job_service: the saga job service the job is running on
+        :param remote_job_state: the already known remote state of the job.
+            The state will be queried if it is not given.
+        :param changes: a list to collect state changes in, they are written
+            right away if it is not given.
+        :return: the remote job state
+        """
         print('Monitoring job %s' % job_id)
         local_job = Job.query.get(job_id)
-        remote_job = job_service.get_job(local_job.remote_job_id)
-
-        # TODO: catch saga.IncorrectState
-        remote_job_state = remote_job.state
+        remote_job = None
+        if remote_job_state is None:
+            remote_job = job_service.get_job(local_job.remote_job_id)
+            # TODO: catch saga.IncorrectState
+            remote_job_state = remote_job.state
 
         if local_job.last_status != remote_job_state:
-            self.send_notifications(local_job, remote_job)
-            self.download_files(local_job, remote_job, job_service)
-            self.update_state(local_job, remote_job)
-
-        # Add task back to the queue if still running
-        if remote_job_state not in (saga.FAILED,
-                                    saga.DONE,
-                                    saga.CANCELED,
-                                    saga.FINAL,
-                                    saga.EXCEPTION):
-            self.send((job_id, job_service))
-
-    def send_notifications(self, local_job, remote_job):
+            if remote_job is None:
+                remote_job = job_service.get_job(local_job.remote_job_id)
+            self.send_notifications(local_job, remote_job_state)
+            # Keep files on the resource until the job is finished
+            self.download_files(local_job,
+                                remote_job,
+                                job_service,
+                                wipe=remote_job_state in TERMINAL_STATES)
+            self.update_state(local_job, remote_job_state, changes)
+        elif remote_job_state == saga.RUNNING and self.is_sync_due(job_id):
+            # Fetch new and changed output files of the running job
+            if remote_job is None:
+                remote_job = job_service.get_job(local_job.remote_job_id)
+            self.download_files(local_job, remote_job, job_service,
+                                wipe=False)
+
+        if remote_job_state in TERMINAL_STATES:
+            # Files are downloaded, remote directory is not needed anymore
+            release_job_endpoint(job_id)
+            self._last_sync.pop(job_id, None)
+
+        return remote_job_state
+
+    def send_notifications(self, local_job, new_state):
         print('sending notifications...')
         # Todo: use signals here
         send_state_change_email(local_job.id,
                                 local_job.owner_id,
                                 local_job.last_status,
-                                remote_job.state,
+                                new_state,
                                 silent=True)
 
-    def download_files(self, local_job, remote_job, job_service):
+    def download_files(self, local_job, remote_job, job_service, wipe=True):
         print('downloading files...')
         # If there are new files, transfer them back, along
         # with output and error files
         download_job_files(local_job.id,
                            remote_job.description,
-                           job_service.get_session())
+                           job_service.get_session(),
+                           wipe=wipe)
+        self._last_sync[local_job.id] = time.time()
 
-    def update_state(self, local_job, remote_job):
+    def is_sync_due(self, job_id):
+        """
+        Returns True if output files of the running job should be synced.
+        """
+        if not self.sync_interval:
+            return False
+        last_sync = self._last_sync.get(job_id, 0)
+        return time.time() - last_sync >= self.sync_interval
+
+    def update_state(self, local_job, new_state, changes=None):
         print('updating state...')
-        # Update last status
-        local_job.last_status = remote_job.state
-        self.db.session.flush()
-        if local_job not in self.db.session:
-            self.db.session.merge(local_job)
-        self.db.session.commit()
+        # Update last status and record the change
+        change = (local_job.id,
+                  local_job.last_status,
+                  new_state,
+                  datetime.datetime.utcnow())
+        if changes is None:
+            self.writer.send([change])
+        else:
+            changes.append(change)
+
+
+class StateWriter(threading.Thread):
+    """
+    Writes job state changes of the monitor to the database along with their
+    history records and publishes them once they are written. All state
+    changes go through this thread, changes which are queued while a
+    transaction is running are written together in the next one. This keeps
+    monitor workers from competing with each other for the database lock on
+    every state change, SQLite allows only one connection to hold it. Workers
+    still record downloaded files of finished jobs themselves, these commits
+    wait for the lock up to SQLITE_BUSY_TIMEOUT milliseconds.
+    """
+
+    def __init__(self, app, *args, **kwargs):
+        """Init."""
+        threading.Thread.__init__(self, *args, **kwargs)
+        self.daemon = True
+        self.app = app
+        self._queue = Queue()
+
+    def send(self, changes):
+        """
+        Queue state changes to be written.
+        :param changes: list of (job id, old state, new state, change time)
+            tuples
+        """
+        self._queue.put(changes)
+
+    def close(self):
+        """Write queued changes and stop the thread."""
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        """Run the writer."""
+        closed = False
+        while not closed:
+            item = self._queue.get()
+            if item is None:
+                break
+            changes = list(item)
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                changes.extend(item)
+            self.write(changes)
+
+    def write(self, changes):
+        """
+        Write the given state changes in one transaction.
+        :param changes: list of (job id, old state, new state, change time)
+            tuples
+        """
+        with self.app.app_context():
+            try:
+                for job_id, old_state, new_state, change_time in changes:
+                    Job.query.filter(Job.id == job_id).update(
+                        {'last_status': new_state,
+                         'last_status_change': change_time},
+                        synchronize_session=False)
+                db.session.add_all(
+                    [JobStateHistory(job_id=job_id,
+                                     old_state=old_state,
+                                     new_state=new_state,
+                                     change_time=change_time)
+                     for job_id, old_state, new_state, change_time
+                     in changes])
+                db.session.commit()
+            except Exception, error:
+                db.session.rollback()
+                self.app.logger.exception(
+                    'Failed to write job states %s: %s' % (changes, error))
+                return
+        for job_id, old_state, new_state, change_time in changes:
+            job_events.publish(job_id, new_state)
+
+
+class MonitorWorker(threading.Thread):
+    """
+    Worker thread which polls batches of jobs handed over by the monitor.
+    """
+
+    def __init__(self, monitor, *args, **kwargs):
+        """Init."""
+        threading.Thread.__init__(self, *args, **kwargs)
+        self.daemon = True
+        self.monitor = monitor
+        self.started_at = None
+        self.busy_time = 0.0
+        self.processed_jobs = 0
+        self.current_resource = None
+
+    def get_stats(self):
+        """
+        Returns a dict of worker statistics. Utilisation is the fraction of
+        time since start which the worker spent on polling.
+        """
+        uptime = time.time() - (self.started_at or time.time())
+        return {'name': self.name,
+                'current_resource': self.current_resource,
+                'processed_jobs': self.processed_jobs,
+                'busy_time': self.busy_time,
+                'utilisation': self.busy_time / uptime if uptime else 0.0}
+
+    def run(self):
+        """Run the worker."""
+        self.started_at = time.time()
+        while True:
+            item = self.monitor._work_queue.get()
+            if item is None:
+                break
+            key, endpoint, context, job_ids = item
+            self.current_resource = endpoint
+            start = time.time()
+            try:
+                self.monitor.poll(endpoint, context, job_ids)
+            except Exception, error:
+                self.monitor.app.logger.exception(
+                    'Monitor worker failed on jobs %s: %s' % (job_ids, error))
+            finally:
+                self.busy_time += time.time() - start
+                self.processed_jobs += len(job_ids)
+                self.current_resource = None
+                self.monitor._finish(endpoint)
+
+
+def get_monitor_lock_file(app):
+    """
+    Returns path of the monitor lock file, which is MONITOR_LOCK_FILE or
+    `monitor.lock' in the staging directory.
+    :param app: flask application
+    """
+    return app.config.get('MONITOR_LOCK_FILE') or \
+        os.path.join(app.config.get('STAGING_DIR', app.instance_path),
+                     'monitor.lock')
+
+
+class MonitorLock(object):
+    """
+    A lock shared by processes on the same host, based on `flock'. The lock
+    is released by the operating system if the holding process dies.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the lock file
+        """
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        """
+        Try to take the lock without blocking.
+        :return: True if the lock is held
+        """
+        if self._file is not None:
+            return True
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    def release(self):
+        """Release the lock if it is held."""
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def get_monitor_stats_file(app, pid):
+    """
+    Returns path of the stats file of the monitor running in the given
+    process, next to the monitor lock file.
+    :param app: flask application
+    :param pid: process id of the monitor
+    """
+    return os.path.join(os.path.dirname(get_monitor_lock_file(app)),
+                        'monitor-stats.%s.json' % pid)
+
+
+def read_monitor_stats(app):
+    """
+    Returns statistics of all running monitors, i.e. the leader or, with
+    login information, every process which monitors jobs. Stats files which
+    are not updated for three MONITOR_STATS_INTERVAL are left out, their
+    monitors are gone.
+    :param app: flask application
+    :return: list of monitor stats
+    """
+    max_age = 3 * app.config.get('MONITOR_STATS_INTERVAL', 10)
+    stats = []
+    for path in glob.glob(get_monitor_stats_file(app, '*')):
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                continue
+            with open(path) as stats_file:
+                stats.append(json.load(stats_file))
+        except (IOError, OSError, ValueError):
+            # Removed or being replaced meanwhile
+            continue
+    return stats
@@ -0,0 +1,185 @@
+"""
+    sqmpy.job.pagination
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Keyset pagination of jobs. Pages are found by comparing (submit_date, id)
+    of jobs with those of the last job on the previous page, which uses the
+    index on jobs instead of skipping rows with OFFSET.
+"""
+import math
+import time
+import datetime
+import threading
+
+from sqlalchemy import and_, or_
+
+from sqmpy.job.exceptions import JobManagerException
+from sqmpy.job.models import Job
+
+__author__ = 'Mehdi Sadeghi'
+
+_CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+# Cached job counts, {owner_id: (count_time, count)}
+_job_counts = {}
+_job_counts_lock = threading.Lock()
+
+
+def make_cursor(job):
+    """
+    Returns a cursor string which points to the given job
+    :param job: Job instance
+    :return: cursor string
+    """
+    return '{date}-{id}'.format(
+        date=job.submit_date.strftime(_CURSOR_DATE_FORMAT), id=job.id)
+
+
+def parse_cursor(cursor):
+    """
+    Parse a cursor made by `make_cursor'
+    :param cursor: cursor string
+    :return: (submit_date, job_id) tuple
+    """
+    try:
+        date, job_id = cursor.split('-', 1)
+        return (datetime.datetime.strptime(date, _CURSOR_DATE_FORMAT),
+                int(job_id))
+    except ValueError:
+        raise JobManagerException('Invalid cursor %s' % cursor)
+
+
+def newest_first(query, after=None, before=None, limit=None, offset=None):
+    """
+    Order jobs by submit date, newest first, and select jobs which come after
+    or before the given cursors.
+    :param query: job query
+    :param after: cursor of the job which selected jobs should come after
+    :param before: cursor of the job which selected jobs should come before
+    :param limit: maximum number of jobs to select
+    :param offset: number of jobs to skip, only used without cursors
+    :return: list of jobs
+    """
+    if before:
+        # Walk backwards and reverse the result
+        submit_date, job_id = parse_cursor(before)
+        query = query.filter(
+            or_(Job.submit_date > submit_date,
+                and_(Job.submit_date == submit_date, Job.id > job_id)))
+        query = query.order_by(Job.submit_date.asc(), Job.id.asc())
+        return list(reversed(query.limit(limit).all()))
+
+    if after:
+        submit_date, job_id = parse_cursor(after)
+        query = query.filter(
+            or_(Job.submit_date < submit_date,
+                and_(Job.submit_date == submit_date, Job.id < job_id)))
+    return query.order_by(Job.submit_date.desc(), Job.id.desc())\
+        .limit(limit).offset(offset).all()
+
+
+def count_jobs(query, owner_id, timeout):
+    """
+    Count jobs of a user, counts are cached for the given time since counting
+    many jobs is slow.
+    :param query: job query
+    :param owner_id: owner of jobs, None for all jobs
+    :param timeout: seconds to cache counts, None to not count at all
+    :return: number of jobs or None
+    """
+    if timeout is None:
+        return None
+    now = time.time()
+    with _job_counts_lock:
+        cached = _job_counts.get(owner_id)
+    if cached is not None and now - cached[0] < timeout:
+        return cached[1]
+    count = query.order_by(None).count()
+    with _job_counts_lock:
+        _job_counts[owner_id] = (now, count)
+    return count
+
+
+def forget_count(owner_id):
+    """
+    Drop cached job count of a user, e.g. after submitting jobs
+    :param owner_id: owner of jobs
+    """
+    with _job_counts_lock:
+        _job_counts.pop(owner_id, None)
+        _job_counts.pop(None, None)
+
+
+class KeysetPagination(object):
+    """
+    A page of jobs. Has the attributes of flask_sqlalchemy.Pagination which
+    are used by templates, plus cursors to the next and previous pages.
+    """
+
+    def __init__(self, page, per_page, items, has_prev, has_next,
+                 total=None):
+        """
+        :param page: page number
+        :param per_page: number of jobs per page
+        :param items: jobs of this page
+        :param has_prev: if there is a previous page
+        :param has_next: if there is a next page
+        :param total: total number of jobs, may be approximate or None
+        """
+        self.page = page
+        self.per_page = per_page
+        self.items = items
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.total = total
+
+    @property
+    def pages(self):
+        """
+        Number of pages, None if total is not known
+        """
+        if self.total is None:
+            return None
+        pages = int(math.ceil(self.total / float(self.per_page)))
+        # Cached totals could be behind
+        if self.has_next:
+            pages = max(pages, self.page + 1)
+        return max(pages, self.page, 1)
+
+    @property
+    def prev_num(self):
+        return self.page - 1
+
+    @property
+    def next_num(self):
+        return self.page + 1
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev and self.items:
+            return make_cursor(self.items[0])
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.items:
+            return make_cursor(self.items[-1])
+
+    def iter_pages(self, left_edge=2, left_current=2,
+                   right_current=5, right_edge=2):
+        """
+        Iterate over page numbers like flask_sqlalchemy.Pagination does.
+        Skipped pages are yielded as None.
+        """
+        pages = self.pages
+        if pages is None:
+            pages = self.next_num if self.has_next else self.page
+        last = 0
+        for num in xrange(1, pages + 1):
+            if num <= left_edge or \
+                    (self.page - left_current - 1 < num <
+                     self.page + right_current) or \
+                    num > pages - right_edge:
+                if last + 1 != num:
+                    yield None
+                yield num
+                last = num
@@ -5,21 +5,31 @@
     Provides ways to interact with saga classes
 """
 import os
+import re
 import pwd
 import time
+import pipes
+import shlex
 import base64
-import hashlib
+import tarfile
+import tempfile
+import datetime
+import threading
+from multiprocessing.pool import ThreadPool
 from threading import Thread
+from collections import OrderedDict
 
 import saga
+import saga.utils.pty_shell
 import flask
 from flask_login import current_user
 
 from sqmpy.job import helpers
 from sqmpy.job.helpers import send_state_change_email
-from sqmpy.job.constants import FileRelation, ScriptType, HPCBackend
+from sqmpy.job.constants import FileRelation, ScriptType, HPCBackend,\
+    TERMINAL_STATES
 from sqmpy.job.exceptions import JobManagerException
-from sqmpy.job.models import StagingFile, Job
+from sqmpy.job.models import StagingFile, Job, RemoteCacheEntry
 from sqmpy.job.callback import JobStateChangeCallback
 from sqmpy.database import db
 
@@ -30,19 +40,26 @@ class SagaJobWrapper(object):
     """
     To wrap, initialize and run a saga job.
     """
-    def __init__(self, job):
+    def __init__(self, job, context=None):
         """
         Init
         :param job: an instance of job model class
+        :param context: saga security context to connect to the resource,
+            will be made for the current user if not given
         :return:
         """
         self._job_id = job.id
         self._job = job
+        self._context = context or make_security_context()
 
         # If job has resource_job_id, connect to it
         if job.remote_job_id:
             self._job_service = self.make_job_service(job.resource_endpoint)
-            self._saga_job = self._job_service.get_job(job.remote_job_id)
+            try:
+                self._saga_job = self._job_service.get_job(job.remote_job_id)
+            except Exception:
+                self.close()
+                raise
         else:
             # Creating the job service object i.e. the connection
             job.resource_endpoint = \
@@ -50,27 +67,12 @@ class SagaJobWrapper(object):
             self._job_service = self.make_job_service(job.resource_endpoint)
 
     def make_job_service(self, endpoint):
-        # Create ssh security context
-        ctx = None
-        session = None
-        if not flask.current_app.config.get('LOGIN_DISABLED') and\
-                flask.current_app.config.get('SSH_WITH_LOGIN_INFO'):
-            # Do not load default security contexts (user ssh keys)
-            session = saga.Session(False)
-            ctx = saga.Context('userpass')
-            ctx.user_id = current_user.username
-            ctx.user_pass =\
-                base64.b64decode(flask.session['password'].decode('utf-8'))
-        else:
-            session = saga.Session()
-            ctx = saga.Context('ssh')
-
-        # Explicitely add the only desired security context
-        session.add_context(ctx)
-        js = saga.job.Service(endpoint, session=session)
-        # TODO: Fix in upstream. Service does not populate adaptor's session.
-        js._adaptor._set_session(session)
-        return js
+        """
+        Borrow a job service for the given endpoint from the pool
+        :param endpoint: resource endpoint
+        :return:
+        """
+        return job_service_pool.get(endpoint, self._context)
 
     def _register_callbacks(self):
         """
@@ -96,17 +98,22 @@ class SagaJobWrapper(object):
         # Set remote job working directory
         remote_job_dir = \
             get_job_endpoint(self._job.id, self._job_service.get_session())
-
-        # Make sure the working directory is empty
-        if remote_job_dir.list():
-            raise JobManagerException('Remote directory is not empty')
-        flask.current_app.logger.debug('Going to transfer files')
-        # transfer job files to remote directory
-        transfer_job_files(self._job.id, remote_job_dir,
-                           self._job_service.get_session())
-        flask.current_app.logger.debug('File transfer done.')
+        try:
+            # Make sure the working directory is empty
+            if remote_job_dir.list():
+                raise JobManagerException('Remote directory is not empty')
+            flask.current_app.logger.debug('Going to transfer files')
+            # transfer job files to remote directory
+            transfer_job_files(self._job.id, remote_job_dir,
+                               self._job_service.get_session())
+            flask.current_app.logger.debug('File transfer done.')
+            remote_path = remote_job_dir.get_url().path
+        finally:
+            # Only the monitor keeps working directories open, it opens them
+            # again when the job is polled
+            release_job_endpoint(self._job.id)
         # Create saga job description
-        jd = make_job_description(self._job, remote_job_dir)
+        jd = make_job_description(self._job, remote_path)
         # Create saga job
         self._saga_job = self._job_service.create_job(jd)
 
@@ -132,8 +139,8 @@ class SagaJobWrapper(object):
         #    (flask.current_app._get_current_object()))
 
         flask.current_app.monitor.send((self._job.id,
-                                        self._job_service))
-
+                                        self._job.resource_endpoint,
+                                        self._context))
 
         flask.current_app.logger.debug(
             "Remote Job ID    : %s" % self._saga_job.id)
@@ -146,6 +153,514 @@ class SagaJobWrapper(object):
         """
         self._saga_job.cancel()
 
+    def close(self):
+        """
+        Hand the job service back to the pool
+        """
+        job_service_pool.put(self._job_service)
+
+
+# Saga job ids look like `[sge+ssh://host]-[1234]'
+_REMOTE_JOB_ID_PATTERN = re.compile(r'^\[(.*)\]-\[(.*)\]$')
+# Endpoint schemes of the saga shell adaptor
+_SHELL_SCHEMES = ('fork', 'local', 'ssh', 'gsissh')
+
+
+def get_service_key(endpoint, context):
+    """
+    Returns a hashable key which identifies a job service by its endpoint
+    and security context.
+    :param endpoint: resource endpoint
+    :param context: saga security context
+    :return:
+    """
+    return (endpoint, context.type, context.user_id)
+
+
+def get_job_states(job_service, remote_job_ids):
+    """
+    Query states of many jobs on the same job service at once. SGE endpoints
+    are queried with a single `qstat' call and jobs started by the shell
+    adaptor with a single `ps' call. Other endpoints have no bulk query,
+    their jobs are left to be polled one by one.
+    :param job_service: saga job service which the jobs are running on
+    :param remote_job_ids: saga ids of the jobs
+    :return: a dict of remote job ids and their states. Jobs with unknown
+        state are not included.
+    """
+    scheme = job_service.get_url().scheme
+    if 'sge' in scheme:
+        return _get_sge_job_states(job_service, remote_job_ids)
+    elif scheme in _SHELL_SCHEMES:
+        return _get_shell_job_states(job_service, remote_job_ids)
+    return {}
+
+
+def _get_native_ids(remote_job_ids):
+    """
+    Returns a dict of native ids of the given saga job ids, i.e. the ids
+    used by the resource, and the saga ids.
+    """
+    native_ids = {}
+    for remote_job_id in remote_job_ids:
+        match = _REMOTE_JOB_ID_PATTERN.match(remote_job_id or '')
+        if match:
+            native_ids[match.group(2)] = remote_job_id
+    return native_ids
+
+
+def _get_shell_job_states(job_service, remote_job_ids):
+    """
+    Query states of jobs started by the shell adaptor using one `ps' call
+    over the pooled shell of the job service. Native ids of these jobs are
+    process ids. Jobs whose processes are gone are left out of the result,
+    their final state and exit code are known to the adaptor only.
+    :param job_service: saga job service of a shell endpoint
+    :param remote_job_ids: saga ids of the jobs
+    :return: a dict of remote job ids and their states
+    """
+    native_ids = dict((pid, remote_job_id) for pid, remote_job_id in
+                      _get_native_ids(remote_job_ids).iteritems()
+                      if pid.isdigit())
+    if not native_ids:
+        return {}
+    # `ps' fails if none of the processes exists anymore
+    out = run_remote_command(
+        job_service.get_url().host,
+        job_service.get_session(),
+        'ps -o pid= -o stat= -p {pids} || true'.format(
+            pids=','.join(native_ids)))
+
+    states = {}
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) < 2 or fields[0] not in native_ids:
+            continue
+        if fields[1].startswith('Z'):
+            # The process has exited
+            continue
+        elif fields[1].startswith('T'):
+            states[native_ids[fields[0]]] = saga.job.SUSPENDED
+        else:
+            states[native_ids[fields[0]]] = saga.job.RUNNING
+    return states
+
+
+def _get_sge_job_states(job_service, remote_job_ids):
+    """
+    Query job states from SGE using one `qstat' call. Finished jobs will not
+    be listed by `qstat' anymore and are left out of the result.
+    :param job_service: saga job service of a sge endpoint
+    :param remote_job_ids: saga ids of the jobs
+    :return: a dict of remote job ids and their states
+    """
+    native_ids = _get_native_ids(remote_job_ids)
+
+    # The sge adaptor keeps an open shell to the remote host, use it. Only
+    # jobs of the remote user are listed, all jobs are ours.
+    ret, out, _ = job_service._adaptor.shell.run_sync(
+        'qstat -u {user}'.format(
+            user=pipes.quote(_get_remote_user(job_service.get_session()))))
+    if ret != 0:
+        raise JobManagerException('Error running qstat: %s' % out)
+
+    states = {}
+    # Skip the two header lines
+    for line in out.splitlines()[2:]:
+        fields = line.split()
+        if len(fields) < 5 or fields[0] not in native_ids:
+            continue
+        state = _get_sge_state(fields[4])
+        if state:
+            states[native_ids[fields[0]]] = state
+    return states
+
+
+def _get_sge_state(state_code):
+    """
+    Translate a `qstat' state code such as `qw' or `r' to a saga state.
+    Returns None if the state can not be decided.
+    """
+    if 'd' in state_code:
+        # Job is being deleted, ask the adaptor for the final state
+        return None
+    elif 'E' in state_code:
+        return saga.job.FAILED
+    elif set(state_code) & set('sST'):
+        return saga.job.SUSPENDED
+    elif set(state_code) & set('rt'):
+        return saga.job.RUNNING
+    elif set(state_code) & set('qwh'):
+        return saga.job.PENDING
+    return None
+
+
+class _PoolEntry(object):
+    """
+    A pooled job service along with its bookkeeping
+    """
+
+    def __init__(self, service, now):
+        self.service = service
+        self.last_used = now
+        self.last_checked = now
+        # Number of callers which have borrowed the service
+        self.borrowed = 0
+        # Retired services are not handed out and closed once returned
+        self.retired = False
+        # Shells opened over the session of the service, by url
+        self.shells = {}
+
+
+class JobServicePool(object):
+    """
+    Keeps saga job services, i.e. connections to remote resources, for reuse.
+    Services are kept per endpoint and security context. When the pool is
+    full the least recently used service is closed. Services which are not
+    used for a while are closed as well and the others are checked from time
+    to time before handing them out.
+
+    Services are shared between callers. Callers borrow a service with `get'
+    and hand it back with `put' once they are done. Services are never closed
+    while they are borrowed, evicted services are closed once the last caller
+    has returned them.
+    """
+
+    def __init__(self, max_size=20, idle_timeout=600,
+                 health_check_interval=60):
+        """
+        Init
+        :param max_size: maximum number of open services
+        :param idle_timeout: seconds after which an unused service is closed
+        :param health_check_interval: seconds after which a service is
+            checked before handing it out again
+        """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        # Maps service keys to entries ordered from the least to the most
+        # recently used service.
+        self._services = OrderedDict()
+        # Borrowed entries by id of their service and its session. Borrowed
+        # entries hold references to both, so the ids are not reused.
+        self._borrowed = {}
+        self._borrowed_sessions = {}
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        """
+        Read pool settings from application config
+        :param config: flask config
+        """
+        self.max_size = config.get('SAGA_POOL_MAX_SIZE', self.max_size)
+        self.idle_timeout = \
+            config.get('SAGA_POOL_IDLE_TIMEOUT', self.idle_timeout)
+        self.health_check_interval = \
+            config.get('SAGA_POOL_HEALTH_CHECK_INTERVAL',
+                       self.health_check_interval)
+
+    def get(self, endpoint, context):
+        """
+        Borrow a job service for the given endpoint and security context,
+        creates a new one if there is no usable service in the pool. The
+        service should be handed back with `put'.
+        :param endpoint: resource endpoint such as `sge+ssh://host'
+        :param context: saga security context
+        :return: saga job service
+        """
+        key = get_service_key(endpoint, context)
+        now = time.time()
+        with self._lock:
+            self._close_idle(now)
+            entry = self._services.pop(key, None)
+            if entry:
+                # Move the service to the most recently used end
+                entry.last_used = now
+                self._services[key] = entry
+                self._borrow(entry)
+
+        if entry and now - entry.last_checked > self.health_check_interval:
+            if self._is_healthy(entry.service):
+                entry.last_checked = now
+            else:
+                with self._lock:
+                    if self._services.get(key) is entry:
+                        del self._services[key]
+                    self._retire(entry)
+                    self._return(entry)
+                entry = None
+        if entry:
+            return entry.service
+
+        # Connect outside of the lock, this might take a while
+        service = _create_job_service(endpoint, context)
+        with self._lock:
+            entry = self._services.get(key)
+            if entry:
+                # Another thread has connected meanwhile, use its service
+                self._close(service)
+            else:
+                entry = _PoolEntry(service, now)
+                self._services[key] = entry
+            self._borrow(entry)
+            while len(self._services) > self.max_size:
+                _, evicted = self._services.popitem(last=False)
+                self._retire(evicted)
+        return entry.service
+
+    def put(self, service):
+        """
+        Hand back a borrowed job service
+        :param service: saga job service returned by `get'
+        """
+        with self._lock:
+            entry = self._borrowed.get(id(service))
+            if entry is not None:
+                entry.last_used = time.time()
+                self._return(entry)
+
+    def get_shell(self, url, session):
+        """
+        Returns a shell to the given url over the session of a borrowed
+        service. Shells are kept open along with the service.
+        :param url: url of the shell such as `ssh://host'
+        :param session: session of a borrowed job service
+        :return: (shell, lock) tuple, None if the session does not belong
+            to a borrowed service
+        """
+        with self._lock:
+            entry = self._borrowed_sessions.get(id(session))
+            if entry is None:
+                return None
+            shell = entry.shells.get(url)
+        if shell:
+            return shell
+
+        # Connect outside of the lock, this might take a while
+        shell = (saga.utils.pty_shell.PTYShell(url, session),
+                 threading.Lock())
+        with self._lock:
+            if url in entry.shells:
+                # Another thread has connected meanwhile, use its shell
+                self._close_shell(shell[0])
+            else:
+                entry.shells[url] = shell
+            return entry.shells[url]
+
+    def clear(self):
+        """
+        Close all pooled services, borrowed ones once they are returned
+        """
+        with self._lock:
+            while self._services:
+                _, entry = self._services.popitem()
+                self._retire(entry)
+
+    def _borrow(self, entry):
+        """
+        Count a borrower of the entry, should be called holding the lock
+        """
+        entry.borrowed += 1
+        self._borrowed[id(entry.service)] = entry
+        self._borrowed_sessions[id(entry.service.get_session())] = entry
+
+    def _return(self, entry):
+        """
+        Count a returned borrow of the entry and close it if it is retired
+        and no longer borrowed, should be called holding the lock
+        """
+        entry.borrowed -= 1
+        if entry.borrowed > 0:
+            return
+        del self._borrowed[id(entry.service)]
+        self._borrowed_sessions.pop(id(entry.service.get_session()), None)
+        if entry.retired:
+            self._close_entry(entry)
+
+    def _retire(self, entry):
+        """
+        Take an entry out of service, it is closed right away unless it is
+        borrowed. Should be called holding the lock.
+        """
+        entry.retired = True
+        if not entry.borrowed:
+            self._close_entry(entry)
+
+    def _close_idle(self, now):
+        """
+        Close services which have not been used within idle timeout
+        """
+        for key, entry in self._services.items():
+            if not entry.borrowed and \
+                    now - entry.last_used > self.idle_timeout:
+                del self._services[key]
+                self._retire(entry)
+
+    def _is_healthy(self, service):
+        """
+        Check if the service is still connected
+        """
+        try:
+            service.list()
+            return True
+        except saga.SagaException:
+            return False
+
+    def _close_entry(self, entry):
+        """
+        Close the shells and the service of an entry
+        """
+        for shell, _ in entry.shells.itervalues():
+            self._close_shell(shell)
+        entry.shells.clear()
+        self._close(entry.service)
+
+    def _close_shell(self, shell):
+        """
+        Close a shell and ignore errors, the connection might be dead.
+        """
+        try:
+            shell.finalize(kill_pty=True)
+        except saga.SagaException:
+            pass
+
+    def _close(self, service):
+        """
+        Close a service and ignore errors, the connection might be dead.
+        """
+        try:
+            service.close()
+        except saga.SagaException:
+            pass
+
+
+# Job services shared by job wrappers, the monitor and file transfers
+job_service_pool = JobServicePool()
+
+
+def uses_login_info(config):
+    """
+    Returns True if users connect to resources with their login information,
+    see `make_security_context'.
+    :param config: application config
+    """
+    return bool(not config.get('LOGIN_DISABLED') and
+                config.get('SSH_WITH_LOGIN_INFO'))
+
+
+def make_security_context():
+    """
+    Create a saga security context for the current user. User login
+    information is used if SSH_WITH_LOGIN_INFO is set, otherwise password-less
+    ssh access is assumed.
+    :return: saga context
+    """
+    if uses_login_info(flask.current_app.config):
+        ctx = saga.Context('userpass')
+        ctx.user_id = current_user.username
+        ctx.user_pass =\
+            base64.b64decode(flask.session['password'].decode('utf-8'))
+    else:
+        ctx = saga.Context('ssh')
+    return ctx
+
+
+def _create_job_service(endpoint, context):
+    """
+    Connect to the given endpoint using only the given security context
+    :param endpoint: resource endpoint
+    :param context: saga security context
+    :return: saga job service
+    """
+    # Do not load default security contexts (user ssh keys) when using
+    # login information
+    session = saga.Session(context.type != 'userpass')
+    # Explicitely add the only desired security context
+    session.add_context(context)
+    js = saga.job.Service(endpoint, session=session)
+    # TODO: Fix in upstream. Service does not populate adaptor's session.
+    js._adaptor._set_session(session)
+    return js
+
+
+def submit_jobs(jobs, context):
+    """
+    Submit a single job or an array of jobs sharing the same files
+    :param jobs: list of job instances
+    :param context: saga security context to connect to the resource
+    :return:
+    """
+    if len(jobs) == 1:
+        saga_wrapper = SagaJobWrapper(jobs[0], context)
+        try:
+            saga_wrapper.run()
+        finally:
+            saga_wrapper.close()
+    else:
+        submit_job_array(jobs, context)
+
+
+def submit_job_array(jobs, context):
+    """
+    Submit jobs which share the same script and input files to the same
+    resource, e.g. tasks of a parameter sweep. Files are uploaded once into
+    the working directory of the first job and linked into the working
+    directories of the others. All jobs are created on one job service and
+    started at once using a saga job container.
+    :param jobs: list of job instances with the same resource and files
+    :param context: saga security context to connect to the resource
+    :return:
+    """
+    first_job = jobs[0]
+    endpoint = get_resource_endpoint(first_job.resource.url,
+                                     first_job.hpc_backend)
+    job_service = job_service_pool.get(endpoint, context)
+    try:
+        session = job_service.get_session()
+
+        # Upload shared files once
+        input_dir = get_job_endpoint(first_job.id, session)
+        try:
+            if input_dir.list():
+                raise JobManagerException('Remote directory is not empty')
+            transfer_job_files(first_job.id, input_dir, session)
+            input_path = input_dir.get_url().path
+        finally:
+            # Only the monitor keeps working directories open
+            release_job_endpoint(first_job.id)
+
+        # Create remote working directories of the other jobs with a few
+        # mkdir calls instead of opening each directory
+        remote_dirs = [set_remote_dir(job, session) for job in jobs[1:]]
+        for i in range(0, len(remote_dirs), 100):
+            run_remote_command(
+                first_job.resource.url,
+                session,
+                'mkdir -p {dirs}'.format(
+                    dirs=' '.join(pipes.quote(path)
+                                  for path in remote_dirs[i:i + 100])))
+
+        container = saga.job.Container()
+        saga_jobs = []
+        for job in jobs:
+            job.resource_endpoint = endpoint
+            jd = make_job_description(job, job.remote_dir, input_path)
+            saga_job = job_service.create_job(jd)
+            container.add(saga_job)
+            saga_jobs.append(saga_job)
+        flask.current_app.logger.debug(
+            "...starting %s jobs..." % len(jobs))
+        container.run()
+
+        # Store remote ids and start monitoring
+        for job, saga_job in zip(jobs, saga_jobs):
+            job.remote_job_id = saga_job.get_id()
+        db.session.commit()
+    finally:
+        job_service_pool.put(job_service)
+    for job in jobs:
+        flask.current_app.monitor.send((job.id, endpoint, context))
+
 
 def get_resource_endpoint(host, hpc_backend):
     """
@@ -169,10 +684,18 @@ def _get_remote_home(session):
     Return homde directory on target resource based on
     the current security context.
     """
+    return '/home/{0}'.format(_get_remote_user(session))
+
+
+def _get_remote_user(session):
+    """
+    Return user name on target resource based on the current security
+    context.
+    """
     user_id = None
     for ctx in session.list_contexts():
         if ctx.type == 'userpass':
-            return '/home/{0}'.format(ctx.user_id)
+            return ctx.user_id
         elif ctx.type == 'ssh':
             user_id = ctx.user_id
 
@@ -185,18 +708,16 @@ def _get_remote_home(session):
         user_id = getpass.getuser()
     if not user_id:
         raise Exception("Can't find the right username for SSH connection.")
-    return '/home/{0}'.format(user_id)
+    return user_id
 
 
-def get_job_endpoint(job_id, session):
+def set_remote_dir(job, session):
     """
-    Returns the remote job working directory. Creates the parent
-    folders if they don't exist.
-    :param job_id: job id
+    Decide the remote working directory of the job if it is not set yet.
+    :param job: job instance
     :param session: saga session to be used
-    :return:
+    :return: remote working directory path
     """
-    job = Job.query.get(job_id)
     # We use a combination of job id and a random string to make the
     # directory name unique and meanwhile human readable
     # Use the staging directory name as remote directory name as well,
@@ -212,7 +733,7 @@ def get_job_endpoint(job_id, session):
             dir_name = os.path.split(job.staging_dir)[-1]
     else:
         # If staging directory is not set make a random name
-        dir_name = "{0}_{1}".format(job_id,
+        dir_name = "{0}_{1}".format(job.id,
                                     base64.urlsafe_b64encode(os.urandom(6)))
 
     if not job.remote_dir:
@@ -222,6 +743,27 @@ def get_job_endpoint(job_id, session):
                 path=dir_name)
     elif not os.path.isabs(job.remote_dir):
         raise Exception('Working directory should be absolute path.')
+    return job.remote_dir
+
+
+# Open remote job working directories as a dict of job ids and dicts of
+# (remote address, session id) and (session, directory) tuples
+_job_directories = {}
+_job_directories_lock = threading.Lock()
+
+
+def get_job_endpoint(job_id, session):
+    """
+    Returns the remote job working directory. Creates the parent
+    folders if they don't exist. Directory handles are cached per job and
+    session until `release_job_endpoint' is called, which callers other than
+    the monitor should do once they are done with the directory.
+    :param job_id: job id
+    :param session: saga session to be used
+    :return:
+    """
+    job = Job.query.get(job_id)
+    set_remote_dir(job, session)
 
     adapter = 'sftp'
     if helpers.is_localhost(job.resource.url):
@@ -232,20 +774,58 @@ def get_job_endpoint(job_id, session):
         adaptor_string.format(adapter=adapter,
                               remote_host=job.resource.url,
                               working_directory=job.remote_dir)
+    # Reuse the directory handle, i.e. the sftp channel, if this job
+    # directory has already been opened with the same session.
+    key = (remote_address, id(session))
+    with _job_directories_lock:
+        cached = _job_directories.get(job_id, {}).get(key)
+    if cached:
+        return cached[1]
+
     # Appropriate folders will be created
-    return \
+    directory = \
         saga.filesystem.Directory(remote_address,
                                   saga.filesystem.CREATE_PARENTS,
                                   session=session)
+    with _job_directories_lock:
+        # Keep a reference to the session, so that its id is not reused
+        cached = _job_directories.setdefault(job_id, {}).setdefault(
+            key, (session, directory))
+    return cached[1]
 
 
-def make_job_description(job, remote_job_dir):
+def release_job_endpoint(job_id):
+    """
+    Close cached remote working directory handles of the given job and forget
+    its output fetches. Should be called once the job has reached a final
+    state.
+    :param job_id: job id
+    :return:
+    """
+    release_job_output(job_id)
+    with _job_directories_lock:
+        cached = _job_directories.pop(job_id, {})
+    for _, directory in cached.itervalues():
+        try:
+            directory.close()
+        except saga.SagaException:
+            pass
+
+
+def make_job_description(job, working_directory, input_directory=None):
     """
     Creates saga job description
     :param job: job instance
-    :param remote_job_dir: saga remote job directory instance
+    :param working_directory: path of the remote job working directory
+    :param input_directory: path of the remote directory containing script
+        and input files, if they are shared with other jobs. Script and input
+        files of the job will be linked into the working directory before the
+        job starts.
     :return:
     """
+    if not input_directory:
+        input_directory = working_directory
+
     script_file = \
         StagingFile.query.filter(
             StagingFile.parent_id == job.id,
@@ -253,7 +833,7 @@ def make_job_description(job, remote_job_dir):
 
     jd = saga.job.Description()
     # TODO: Add queue name, project and other params
-    jd.working_directory = remote_job_dir.get_url().path
+    jd.working_directory = working_directory
     jd.total_cpu_count = job.total_cpu_count
     jd.wall_time_limit = job.walltime_limit
     jd.spmd_variation = job.spmd_variation
@@ -269,32 +849,63 @@ def make_job_description(job, remote_job_dir):
         jd.executable = '/usr/bin/python'
     if job.script_type == ScriptType.shell.value:
         jd.executable = '/bin/sh'
-    script_abs_path = '{dir}/{file}'.format(dir=remote_job_dir.get_url().path,
+    script_abs_path = '{dir}/{file}'.format(dir=input_directory,
                                             file=script_file.name)
     jd.arguments = [script_abs_path]
+    if job.arguments:
+        # Parameters of the script
+        jd.arguments += shlex.split(job.arguments)
+    if input_directory != working_directory:
+        # Link only the script and input files, since the input directory is
+        # the working directory of another job and holds its outputs as well
+        input_names = [
+            sf.name for sf in StagingFile.query.filter(
+                StagingFile.parent_id == job.id,
+                StagingFile.relation.in_([FileRelation.input.value,
+                                          FileRelation.script.value]))]
+        jd.pre_exec = ['ln -s {paths} .'.format(
+            paths=' '.join(pipes.quote('{dir}/{file}'.format(
+                dir=input_directory, file=name)) for name in input_names))]
 
-    jd.output = '{script_name}.out.txt'.format(script_name=script_file.name)
-    jd.error = '{script_name}.err.txt'.format(script_name=script_file.name)
+    jd.output = get_output_name(script_file.name, FileRelation.stdout)
+    jd.error = get_output_name(script_file.name, FileRelation.stderr)
     return jd
 
 
+def get_output_name(script_name, relation):
+    """
+    Returns name of the standard output or error file of a job
+    :param script_name: name of the job script
+    :param relation: FileRelation.stdout or FileRelation.stderr
+    """
+    if relation == FileRelation.stdout:
+        return '{script_name}.out.txt'.format(script_name=script_name)
+    return '{script_name}.err.txt'.format(script_name=script_name)
+
+
 def download_job_files(job_id, job_description, session, wipe=True):
     """
     Copies output and error files along with any other output files back to the
-    current machine.
+    current machine. Staging file records of downloaded files act as a
+    manifest, only files which are new or whose size or modification time
+    has changed since the last download are transferred.
     :param job_id: job id
     :param job_description:
     :param session: saga session to remote resource
     :param wipe: if set to True will wipe files from remote machine.
     :return:
     """
-    # Get staging file names for this job which are already uploaded
-    # we don't need to download them since we have them already
+    # Get staging files of this job by their local path. Uploaded files are
+    # not downloaded again and downloaded ones only if they have changed.
     staged_files = \
-        StagingFile.query.filter(StagingFile.parent_id == Job.id,
-                                 Job.id == job_id).all()
-    # Convert tuple result to list
-    excluded = [os.path.join(sf.location, sf.name) for sf in staged_files]
+        StagingFile.query.filter(StagingFile.parent_id == job_id).all()
+    manifest = dict((os.path.join(sf.location, sf.name), sf)
+                    for sf in staged_files)
+    # Names of uploaded files, which might be linked into the working
+    # directory from a shared input directory
+    uploaded_names = set(sf.name for sf in staged_files
+                         if sf.relation in (FileRelation.input.value,
+                                            FileRelation.script.value))
 
     # Get or create job directory
     job_staging_folder = helpers.get_job_staging_folder(job_id)
@@ -304,7 +915,11 @@ def download_job_files(job_id, job_description, session, wipe=True):
 
     # Find all files in the working directory and its subdirectories
     # Files are as a dict of full_path/saga.filesystem.Url objects
-    remote_files, sub_direcotires = _traverse_directory(remote_dir)
+    remote_files, sub_direcotires, remote_file_info = \
+        _list_directory(remote_dir, session)
+
+    # Records of downloaded files along with their local paths
+    downloaded_files = []
 
     # Copy/move files and create corresponding records in db
     # Note: we can recursively move everything back but the reason
@@ -323,36 +938,215 @@ def download_job_files(job_id, job_description, session, wipe=True):
         # No sftp in path
         local_abspath = os.path.join(job_staging_folder, relative_path)
 
-        # Do nothing if the file is already downloaded or belongs
-        # to initially uploaded files.
-        if local_abspath in excluded:
+        sf = manifest.get(local_abspath)
+        # Do nothing if the file belongs to initially uploaded files.
+        if relative_path in uploaded_names or \
+                sf and sf.relation in (FileRelation.input.value,
+                                       FileRelation.script.value):
             flask.current_app.logger.debug('Excluding %s' % local_abspath)
             continue
 
+        size, modified = \
+            remote_file_info.get(remote_abspath) or \
+            _get_remote_file_info(remote_dir, remote_abspath)
+        # Do not transfer the file if it is already downloaded and unchanged,
+        # only remove the remote copy when wiping
+        if sf and (sf.size, sf.modified) == (size, modified):
+            flask.current_app.logger.debug('Unchanged %s' % local_abspath)
+            if wipe:
+                remote_dir.remove(remote_abspath)
+            continue
+
+        flags = saga.filesystem.CREATE_PARENTS | saga.filesystem.OVERWRITE
         if wipe:
             # Move the file and create parents if required
-            remote_dir.move(remote_abspath, local_path,
-                            saga.filesystem.CREATE_PARENTS)
+            remote_dir.move(remote_abspath, local_path, flags)
         else:
             # Copy the file and create parents if required
-            remote_dir.copy(remote_abspath, local_path,
-                            saga.filesystem.CREATE_PARENTS)
-
-        # Insert appropriate record into db
-        sf = StagingFile()
-        sf.name = remote_url.path
-        sf.original_name = remote_url.path
-        sf.location = os.path.dirname(local_abspath)
-        sf.relative_path = relative_path.lstrip(os.sep)
-        sf.relation = _get_file_relation_to_job(job_description, remote_url)
-        sf.checksum = hashlib.md5(open(local_abspath).read()).hexdigest()
-        sf.parent_id = job_id
-        db.session.add(sf)
+            remote_dir.copy(remote_abspath, local_path, flags)
+
+        if not sf:
+            # Insert appropriate record into db
+            sf = StagingFile()
+            sf.name = remote_url.path
+            sf.original_name = remote_url.path
+            sf.location = os.path.dirname(local_abspath)
+            sf.relative_path = relative_path.lstrip(os.sep)
+            sf.relation = \
+                _get_file_relation_to_job(job_description, remote_url)
+            sf.parent_id = job_id
+            db.session.add(sf)
+        sf.size = size
+        sf.modified = modified
+        downloaded_files.append((sf, local_abspath))
+
+    # Compute checksums of downloaded files in parallel
+    checksums = \
+        helpers.get_file_checksums([path for _, path in downloaded_files])
+    for (sf, _), checksum in zip(downloaded_files, checksums):
+        sf.checksum = checksum
 
     # Persist changes
     db.session.commit()
 
 
+def sync_job_outputs(job_id, context=None):
+    """
+    Download new and changed files of a job while keeping them on the remote
+    resource. Can be called periodically for running jobs.
+    :param job_id: job id
+    :param context: saga security context to connect to the resource,
+        will be made for the current user if not given
+    :return:
+    """
+    job = Job.query.get(job_id)
+    if not job or not job.remote_job_id:
+        raise JobManagerException('Job %s is not submitted yet.' % job_id)
+    job_service = job_service_pool.get(job.resource_endpoint,
+                                       context or make_security_context())
+    try:
+        remote_job = job_service.get_job(job.remote_job_id)
+        download_job_files(job_id,
+                           remote_job.description,
+                           job_service.get_session(),
+                           wipe=False)
+    finally:
+        job_service_pool.put(job_service)
+
+
+# Locks and last fetch times of cached job outputs, by job id and relation.
+# They are dropped once the job is finished, see release_job_output.
+_output_locks = {}
+_output_fetch_times = {}
+_output_locks_lock = threading.Lock()
+
+
+def read_job_output(job_id, relation, offset=0, context=None, config=None):
+    """
+    Read standard output or error of a job from the given offset, without
+    downloading the whole file. Only new bytes are fetched from the remote
+    working directory and appended to a local copy, which serves readers at
+    any offset. Once the job is finished the downloaded file is read, if
+    there is none the output is finished without fetching it again.
+    :param job_id: job id
+    :param relation: FileRelation.stdout or FileRelation.stderr
+    :param offset: number of bytes the reader already has
+    :param context: saga security context to connect to the resource,
+        will be made for the current user if not given
+    :param config: application config
+    :return: (data, offset after data, finished) tuple, finished is True if
+        no more data will come
+    """
+    config = config or flask.current_app.config
+    # Always read the current state of the job
+    job = Job.query.populate_existing().get(job_id)
+    if not job or not job.remote_job_id:
+        raise JobManagerException('Job %s is not submitted yet.' % job_id)
+    finished = job.last_status in TERMINAL_STATES
+    downloaded = StagingFile.query.filter(
+        StagingFile.parent_id == job_id,
+        StagingFile.relation == relation.value).first()
+    if finished:
+        release_job_output(job_id)
+    if finished and downloaded:
+        path = downloaded.get_path()
+    elif finished:
+        # Nothing was downloaded, the job will not write anymore
+        return '', offset, True
+    else:
+        path = _fetch_job_output(job, relation, context, config)
+        # The rest is read from the downloaded file
+        finished = False
+
+    if not os.path.exists(path):
+        # Nothing is written yet
+        return '', offset, finished
+    with open(path, 'rb') as output_file:
+        output_file.seek(offset)
+        data = output_file.read(
+            config.get('OUTPUT_MAX_CHUNK_SIZE', 64 * 1024))
+    offset += len(data)
+    return data, offset, finished and offset >= os.path.getsize(path)
+
+
+def _fetch_job_output(job, relation, context, config):
+    """
+    Append new bytes of a remote job output to its local copy. Outputs are
+    fetched at most every OUTPUT_FETCH_INTERVAL seconds, no matter how many
+    readers there are.
+    :return: path of the local copy
+    """
+    script_file = StagingFile.query.filter(
+        StagingFile.parent_id == job.id,
+        StagingFile.relation == FileRelation.script.value).first()
+    name = get_output_name(script_file.name, relation)
+    cache_path = os.path.join(job.staging_dir or
+                              helpers.get_job_staging_folder(job.id),
+                              '.output', name)
+    key = (job.id, relation.value)
+    with _output_locks_lock:
+        lock = _output_locks.setdefault(key, threading.Lock())
+
+    with lock:
+        last_fetch = _output_fetch_times.get(key, 0)
+        if time.time() - last_fetch < config.get('OUTPUT_FETCH_INTERVAL', 0):
+            return cache_path
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        size = os.path.getsize(cache_path) \
+            if os.path.exists(cache_path) else 0
+
+        # Output is encoded since the shell is not binary safe
+        job_service = \
+            job_service_pool.get(job.resource_endpoint,
+                                 context or make_security_context())
+        remote_path = '{0}/{1}'.format(job.remote_dir, name)
+        command = 'test -f {path} && tail -c +{start} {path} | ' \
+                  'head -c {size} | base64 || true'.format(
+                      path=pipes.quote(remote_path),
+                      start=size + 1,
+                      size=config.get('OUTPUT_MAX_FETCH_SIZE', 1024 * 1024))
+        try:
+            out = run_remote_command(saga.Url(job.resource_endpoint).host,
+                                     job_service.get_session(),
+                                     command)
+        finally:
+            job_service_pool.put(job_service)
+        data = base64.b64decode(out)
+        if data:
+            # Writing at the offset keeps the copy consistent when another
+            # process has fetched the same bytes
+            mode = 'r+b' if os.path.exists(cache_path) else 'wb'
+            with open(cache_path, mode) as cache_file:
+                cache_file.seek(size)
+                cache_file.write(data)
+        _output_fetch_times[key] = time.time()
+    return cache_path
+
+
+def release_job_output(job_id):
+    """
+    Forget locks and fetch times of the outputs of a finished job, its output
+    is not fetched anymore.
+    :param job_id: job id
+    """
+    with _output_locks_lock:
+        for relation in (FileRelation.stdout, FileRelation.stderr):
+            _output_locks.pop((job_id, relation.value), None)
+            _output_fetch_times.pop((job_id, relation.value), None)
+
+
+def _get_remote_file_info(remote_dir, remote_abspath):
+    """
+    Returns size and modification time of a remote file. Saga does not
+    provide modification times, therefore it is always None.
+    :param remote_dir: saga.filesystem.Directory instance
+    :param remote_abspath: absolute path of the remote file
+    :return: (size, modified) tuple
+    """
+    return remote_dir.get_size(remote_abspath), None
+
+
 def _get_file_relation_to_job(job_description, file_url):
     """
     Find if file is stdout, stderr or generated output.
@@ -384,6 +1178,72 @@ def _make_relative_path(base_path, full_path):
         return rel_path
 
 
+def _list_directory(directory, session, config=None):
+    """
+    Collect all files and subdirectories of a remote directory. If
+    FAST_REMOTE_LISTING is set, the whole tree is listed with a single `find'
+    command, otherwise or if that fails, the directory is walked with saga.
+    :param directory: instance of saga.filesystem.Directory
+    :param session: saga session to be used
+    :param config: application config
+    :return: a tuple of collected files, collected directories and a dict of
+        file paths and their (size, modification time). With the walk the
+        collected directories are saga.filesystem.Directory instances and the
+        dict is empty, with `find' the collected directories are saga.Url
+        instances.
+    """
+    if not config:
+        config = flask.current_app.config
+    if config.get('FAST_REMOTE_LISTING'):
+        try:
+            return _find_directory_tree(directory, session)
+        except Exception, error:
+            flask.current_app.logger.debug(
+                'Listing with find failed, walking the directory: %s' % error)
+    collected_files, collected_directories = _traverse_directory(directory)
+    return collected_files, collected_directories, {}
+
+
+def _find_directory_tree(directory, session):
+    """
+    List the whole tree under a remote directory with a single GNU `find'
+    command over the shell of the session.
+    :param directory: instance of saga.filesystem.Directory
+    :param session: saga session to be used
+    :return: see `_list_directory'
+    """
+    base_path = directory.get_url().get_path()
+    # Print type, size, modification time and relative path of each entry
+    output = run_remote_command(
+        directory.get_url().host,
+        session,
+        "find {path} -mindepth 1 -printf '%y %s %T@ %P\\n'".format(
+            path=pipes.quote(base_path)))
+
+    collected_files = {}
+    collected_directories = []
+    file_info = {}
+    for line in output.splitlines():
+        fields = line.split(' ', 3)
+        if len(fields) != 4:
+            continue
+        entry_type, size, modified, relative_path = fields
+        full_path = os.path.join(base_path, relative_path)
+        if entry_type == 'f':
+            # Same as directory listings, entries are named relative to
+            # their parent directory
+            collected_files[full_path] = \
+                saga.Url(os.path.basename(relative_path))
+            file_info[full_path] = (int(size), float(modified))
+        elif entry_type == 'd':
+            collected_directories.append(
+                saga.Url('{scheme}://{host}{path}'.format(
+                    scheme=directory.get_url().get_scheme(),
+                    host=directory.get_url().get_host(),
+                    path=full_path)))
+    return collected_files, collected_directories, file_info
+
+
 def _traverse_directory(directory,
                         collected_files=None,
                         collected_directories=None):
@@ -434,30 +1294,283 @@ def _traverse_directory(directory,
     return collected_files, collected_directories
 
 
-def transfer_job_files(job_id, remote_job_dir, session):
+def transfer_job_files(job_id, remote_job_dir, session, config=None):
     """
-    Upload job files to remote resource
+    Upload job files to remote resource. Files are uploaded in parallel
+    using UPLOAD_WORKERS threads sharing the given session. If
+    UPLOAD_BUNDLE_SMALL_FILES is set, files up to UPLOAD_BUNDLE_MAX_FILE_SIZE
+    bytes are packed into one tar archive which is unpacked on the resource.
+    If REMOTE_CACHE is set, files which are already cached on the resource
+    are copied there instead of being uploaded and uploaded files are added
+    to the cache.
     :param job_id: job id
     :param remote_job_dir: saga.filesystem.Directory instance
         of remote job directory
     :param session: saga.Session instance for this transfer
+    :param config: application config
     :return
     """
+    if not config:
+        config = flask.current_app.config
+
     # Copy script and input files to remote host
     uploading_files = \
         StagingFile.query.filter(
             StagingFile.parent_id == job_id,
             StagingFile.relation.in_([FileRelation.input.value,
                                       FileRelation.script.value])).all()
-    for file_to_upload in uploading_files:
-        # If we don't pass correct session object, saga will create default
-        # session object which will not reflect correct security context.
-        # it would be useful only for a local run and not multi-user run
-        # session and remote_job_dir._adaptor.session should be the same
-        file_wrapper = \
-            saga.filesystem.File('file://localhost/{file_path}'
-                                 .format(file_path=file_to_upload.get_path()),
-                                 session=session)
-        # TODO: This is a workaround for bug #480 remove it later
-        file_wrapper._adaptor._set_session(session)
-        file_wrapper.copy(remote_job_dir.get_url(), saga.filesystem.RECURSIVE)
+
+    if config.get('REMOTE_CACHE'):
+        uploading_files = _copy_cached_files(job_id,
+                                             uploading_files,
+                                             remote_job_dir,
+                                             session,
+                                             config)
+    file_paths = [sf.get_path() for sf in uploading_files]
+
+    if config.get('UPLOAD_BUNDLE_SMALL_FILES'):
+        max_size = config.get('UPLOAD_BUNDLE_MAX_FILE_SIZE')
+        small_files = [path for path in file_paths
+                       if os.path.getsize(path) <= max_size]
+        # Bundling a single file would not save anything
+        if len(small_files) > 1:
+            _upload_bundle(small_files, remote_job_dir, session)
+            file_paths = [path for path in file_paths
+                          if path not in small_files]
+
+    workers = min(config.get('UPLOAD_WORKERS', 1), len(file_paths))
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            pool.map(lambda path: _upload_file(path, remote_job_dir, session),
+                     file_paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for path in file_paths:
+            _upload_file(path, remote_job_dir, session)
+
+    if config.get('REMOTE_CACHE'):
+        _cache_uploaded_files(job_id,
+                              uploading_files,
+                              remote_job_dir,
+                              session,
+                              config)
+
+
+def _get_cacheable_files(staging_files, config):
+    """
+    Returns files which are large enough to be cached on resources
+    """
+    min_size = config.get('REMOTE_CACHE_MIN_FILE_SIZE', 0)
+    return [sf for sf in staging_files
+            if sf.checksum and sf.size is not None and sf.size >= min_size]
+
+
+def _copy_cached_files(job_id, staging_files, remote_job_dir, session,
+                       config):
+    """
+    Copy files which are cached on the resource into the remote job
+    directory.
+    :param job_id: job id
+    :param staging_files: staging files to be uploaded
+    :param remote_job_dir: saga.filesystem.Directory instance
+    :param session: saga.Session instance for this transfer
+    :param config: application config
+    :return: staging files which are not cached and should be uploaded
+    """
+    candidates = _get_cacheable_files(staging_files, config)
+    if not candidates:
+        return staging_files
+
+    job = Job.query.get(job_id)
+    # Cached files are in home directories, other users can not read them
+    entries = RemoteCacheEntry.query.filter(
+        RemoteCacheEntry.resource_id == job.resource_id,
+        RemoteCacheEntry.remote_user == _get_remote_user(session),
+        RemoteCacheEntry.checksum.in_(
+            [sf.checksum for sf in candidates])).all()
+    cached = dict((entry.checksum, entry) for entry in entries)
+    hits = [sf for sf in candidates if sf.checksum in cached]
+    if not hits:
+        return staging_files
+
+    job_dir = remote_job_dir.get_url().path
+    commands = ['cp {src} {dst}'.format(
+        src=pipes.quote(cached[sf.checksum].path),
+        dst=pipes.quote('{0}/{1}'.format(job_dir, sf.name)))
+        for sf in hits]
+    try:
+        _run_remote_commands(remote_job_dir.get_url().host, session, commands)
+    except JobManagerException, error:
+        # Cached files have been removed from the resource, forget about
+        # them and upload the files
+        flask.current_app.logger.debug(
+            'Failed to copy cached files: %s' % error)
+        for entry in entries:
+            db.session.delete(entry)
+        return staging_files
+
+    now = datetime.datetime.utcnow()
+    for entry in entries:
+        entry.last_used = now
+    return [sf for sf in staging_files if sf not in hits]
+
+
+def _cache_uploaded_files(job_id, staging_files, remote_job_dir, session,
+                          config):
+    """
+    Copy uploaded files from remote job directory into the cache directory of
+    the resource, i.e. `~/.sqmpy/cache/<checksum>', and record them. Cached
+    files which have not been used for REMOTE_CACHE_MAX_AGE seconds are
+    removed meanwhile. Errors are only logged, since the job files are
+    uploaded anyway.
+    :param job_id: job id
+    :param staging_files: uploaded staging files
+    :param remote_job_dir: saga.filesystem.Directory instance
+    :param session: saga.Session instance for this transfer
+    :param config: application config
+    """
+    files = {}
+    for sf in _get_cacheable_files(staging_files, config):
+        files.setdefault(sf.checksum, sf)
+    if not files:
+        return
+
+    job = Job.query.get(job_id)
+    remote_user = _get_remote_user(session)
+    cache_dir = '{home_directory}/.sqmpy/cache'.format(
+        home_directory=_get_remote_home(session))
+    job_dir = remote_job_dir.get_url().path
+    commands = ['mkdir -p {0}'.format(pipes.quote(cache_dir))]
+
+    expired = []
+    if config.get('REMOTE_CACHE_MAX_AGE'):
+        expiry = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=config.get('REMOTE_CACHE_MAX_AGE'))
+        expired = RemoteCacheEntry.query.filter(
+            RemoteCacheEntry.resource_id == job.resource_id,
+            RemoteCacheEntry.remote_user == remote_user,
+            RemoteCacheEntry.last_used < expiry,
+            ~RemoteCacheEntry.checksum.in_(files.keys())).all()
+        commands.extend('rm -f {0}'.format(pipes.quote(entry.path))
+                        for entry in expired)
+
+    entries = []
+    for checksum, sf in files.iteritems():
+        entry = RemoteCacheEntry()
+        entry.resource_id = job.resource_id
+        entry.remote_user = remote_user
+        entry.checksum = checksum
+        entry.path = '{0}/{1}'.format(cache_dir, checksum)
+        entry.last_used = datetime.datetime.utcnow()
+        commands.append('cp {src} {dst}'.format(
+            src=pipes.quote('{0}/{1}'.format(job_dir, sf.name)),
+            dst=pipes.quote(entry.path)))
+        entries.append(entry)
+    try:
+        _run_remote_commands(remote_job_dir.get_url().host, session, commands)
+    except JobManagerException, error:
+        flask.current_app.logger.debug(
+            'Failed to cache uploaded files: %s' % error)
+        return
+    for entry in expired:
+        db.session.delete(entry)
+    db.session.add_all(entries)
+
+
+def _run_remote_commands(host, session, commands, chunk_size=100):
+    """
+    Run many shell commands using as few remote calls as possible. Commands
+    are chained with `&&', so a chain stops at the first failure.
+    :param host: host name of the resource
+    :param session: saga session to be used
+    :param commands: list of shell commands
+    :param chunk_size: maximum number of commands per remote call
+    """
+    for i in range(0, len(commands), chunk_size):
+        run_remote_command(host, session,
+                           ' && '.join(commands[i:i + chunk_size]))
+
+
+def _upload_file(file_path, remote_job_dir, session):
+    """
+    Copy a local file into the remote job directory
+    :param file_path: absolute path of the local file
+    :param remote_job_dir: saga.filesystem.Directory instance
+    :param session: saga.Session instance for this transfer
+    """
+    # If we don't pass correct session object, saga will create default
+    # session object which will not reflect correct security context.
+    # it would be useful only for a local run and not multi-user run
+    # session and remote_job_dir._adaptor.session should be the same
+    file_wrapper = \
+        saga.filesystem.File('file://localhost/{file_path}'
+                             .format(file_path=file_path),
+                             session=session)
+    # TODO: This is a workaround for bug #480 remove it later
+    file_wrapper._adaptor._set_session(session)
+    file_wrapper.copy(remote_job_dir.get_url(), saga.filesystem.RECURSIVE)
+
+
+def _upload_bundle(file_paths, remote_job_dir, session):
+    """
+    Pack files into a tar archive, upload it and unpack it in the remote job
+    directory.
+    :param file_paths: absolute paths of local files
+    :param remote_job_dir: saga.filesystem.Directory instance
+    :param session: saga.Session instance for this transfer
+    """
+    fd, bundle_path = tempfile.mkstemp(prefix='sqmpy_bundle_', suffix='.tar')
+    os.close(fd)
+    try:
+        bundle = tarfile.open(bundle_path, 'w')
+        try:
+            for path in file_paths:
+                bundle.add(path, arcname=os.path.basename(path))
+        finally:
+            bundle.close()
+        _upload_file(bundle_path, remote_job_dir, session)
+        bundle_name = pipes.quote(os.path.basename(bundle_path))
+        run_remote_command(
+            remote_job_dir.get_url().host,
+            session,
+            'cd {dir} && tar -xf {bundle} && rm -f {bundle}'.format(
+                dir=pipes.quote(remote_job_dir.get_url().path),
+                bundle=bundle_name))
+    finally:
+        os.remove(bundle_path)
+
+
+def run_remote_command(host, session, command):
+    """
+    Run a shell command on the given host and return its output. Shells are
+    kept open along with the pooled job service of the session, other
+    sessions get a new shell for each command.
+    :param host: host name of the resource
+    :param session: saga session to be used
+    :param command: shell command
+    :return: standard output of the command
+    """
+    url = 'ssh://{host}'.format(host=host)
+    if helpers.is_localhost(host):
+        url = 'fork://localhost'
+    pooled = job_service_pool.get_shell(url, session)
+    if pooled:
+        shell, shell_lock = pooled
+    else:
+        shell, shell_lock = \
+            saga.utils.pty_shell.PTYShell(url, session), threading.Lock()
+
+    try:
+        with shell_lock:
+            ret, out, err = shell.run_sync(command)
+    finally:
+        if not pooled:
+            shell.finalize(kill_pty=True)
+    if ret != 0:
+        raise JobManagerException(
+            'Remote command failed on {host}: {error}'.format(
+                host=host, error=err or out))
+    return out
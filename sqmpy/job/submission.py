@@ -0,0 +1,120 @@
+"""Background job submission."""
+import datetime
+import threading
+from Queue import Queue
+
+from sqmpy.database import db
+from sqmpy.job.constants import JobStatus
+from sqmpy.job.models import Job
+from sqmpy.job.saga_helper import submit_jobs
+
+
+class JobSubmissionPool(object):
+    """
+    A pool of threads which submit staged jobs to remote resources in
+    background. Jobs are expected to be in SUBMITTING state, on success the
+    job wrapper stores the remote job id and hands the job over to the
+    monitor, on failure the job is marked as failed.
+
+    Queued submissions are lost when the process stops. Login information of
+    their users is not stored, so they can not be queued again. Such jobs are
+    marked as failed once SUBMISSION_TIMEOUT has passed, see
+    `fail_stale_jobs'.
+    """
+
+    def __init__(self, app, size=4):
+        """
+        Init
+        :param app: flask application
+        :param size: number of submission threads
+        """
+        self.app = app
+        self.input_queue = Queue()
+        self.workers = [threading.Thread(target=self._work,
+                                         name='sqmpy-submitter-%s' % i)
+                        for i in range(size)]
+        for worker in self.workers:
+            worker.daemon = True
+
+    def start(self):
+        """Start submission threads."""
+        self.fail_stale_jobs()
+        for worker in self.workers:
+            worker.start()
+
+    def fail_stale_jobs(self, timeout=None):
+        """
+        Mark jobs as failed which are still submitting without a remote job
+        id longer than the given time after their submit date. Their
+        submission has been lost, e.g. by restarting the process which was
+        submitting them. Other processes could still be submitting newer
+        jobs, so those are left alone.
+        :param timeout: seconds, SUBMISSION_TIMEOUT by default
+        :return: number of failed jobs
+        """
+        if timeout is None:
+            timeout = self.app.config.get('SUBMISSION_TIMEOUT')
+        if timeout is None:
+            return 0
+        deadline = \
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout)
+        with self.app.app_context():
+            jobs = Job.query.filter(
+                Job.last_status == JobStatus.SUBMITTING,
+                Job.remote_job_id.is_(None),
+                Job.submit_date < deadline).all()
+            job_ids = [job.id for job in jobs]
+            for job in jobs:
+                job.set_state(JobStatus.FAILED)
+            db.session.commit()
+        if job_ids:
+            self.app.logger.warning(
+                'Marked stale submitting jobs %s as failed' % job_ids)
+        return len(job_ids)
+
+    def send(self, item):
+        """
+        Send jobs to submit.
+        :param item: a tuple of a list of job ids and saga security context
+            to connect to the resource. Many jobs are submitted as an array,
+            see `saga_helper.submit_jobs'.
+        """
+        self.input_queue.put(item)
+
+    def close(self):
+        """Wait for queued submissions and stop the threads."""
+        for worker in self.workers:
+            self.input_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def get_stats(self):
+        """Returns number of queued submissions."""
+        return {'queued_jobs': self.input_queue.qsize()}
+
+    def _work(self):
+        """Submit queued jobs until closed."""
+        while True:
+            item = self.input_queue.get()
+            if item is None:
+                break
+            job_ids, context = item
+            with self.app.app_context():
+                self.submit(job_ids, context)
+
+    def submit(self, job_ids, context):
+        """
+        Submit jobs, mark them failed on errors.
+        :param job_ids: list of job ids
+        :param context: saga security context
+        """
+        jobs = [Job.query.get(job_id) for job_id in job_ids]
+        try:
+            submit_jobs(jobs, context)
+        except Exception, error:
+            self.app.logger.exception(
+                'Failed to submit jobs %s: %s' % (job_ids, error))
+            db.session.rollback()
+            for job in Job.query.filter(Job.id.in_(job_ids)):
+                job.set_state(JobStatus.FAILED)
+            db.session.commit()
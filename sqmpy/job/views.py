@@ -5,21 +5,26 @@
     View functions for jobs module
 """
 import os
+import json
+import time
 import shutil
 import tempfile
-import mimetypes
 
-from flask import request, redirect, url_for, abort,\
-    render_template, flash, send_from_directory, Blueprint, g
-from flask_login import login_required
+from flask import request, redirect, url_for, abort, current_app, jsonify,\
+    render_template, flash, Blueprint, g, Response, stream_with_context
+from flask_login import login_required, current_user
 from werkzeug import secure_filename
 from flask_wtf import CSRFProtect
 
-from sqmpy.job.exceptions import JobNotFoundException
+from sqmpy.job.exceptions import JobNotFoundException, JobManagerException
 from sqmpy.job.forms import JobSubmissionForm
 from sqmpy.job.models import Resource
-from sqmpy.job.constants import ScriptType
+from sqmpy.job.constants import ScriptType, FileRelation, TERMINAL_STATES
+from sqmpy.job import helpers
+from sqmpy.job.events import job_events
 from sqmpy.job import manager as job_services
+from sqmpy.job.monitor import read_monitor_stats
+from sqmpy.security.constants import UserRole
 from sqmpy.utils import get_redirect_target
 
 
@@ -48,10 +53,18 @@ def index(page):
     Entry page for job subsystem
     :return:
     """
-    pagination = job_services.list_jobs(page=page)
+    try:
+        pagination = job_services.list_jobs(page=page,
+                                            after=request.args.get('after'),
+                                            before=request.args.get('before'))
+    except JobManagerException:
+        abort(400)
     return render_template('job/job_list.html',
                            pagination=pagination,
-                           jobs=pagination.items)
+                           jobs=pagination.items,
+                           running_job_ids=[
+                               job.id for job in pagination.items
+                               if job.last_status not in TERMINAL_STATES])
 
 
 @job_blueprint.route('/<string:job_id>', methods=['GET'])
@@ -62,8 +75,11 @@ def detail(job_id):
     :return:
     """
     try:
-        job = job_services.get_job(job_id)
-        return render_template('job/job_detail.html', job=job)
+        job = job_services.get_job(job_id, with_files=True)
+        return render_template(
+            'job/job_detail.html',
+            job=job,
+            finished=job.last_status in TERMINAL_STATES)
     except JobNotFoundException:
         abort(404)
 
@@ -89,6 +105,9 @@ def submit(job_id=None):
     upload_dir = tempfile.mkdtemp()
 
     if form.validate_on_submit():
+        # Checksums and sizes of uploaded files, computed while receiving them
+        checksums = {}
+
         # Save script file to upload directory
         script_file = request.files.get('script_file')
 
@@ -99,8 +118,10 @@ def submit(job_id=None):
         script_type = _recognize_script_type(script_safe_filename)
 
         # TODO: recognize she bang in scripts
-        script_file.save(os.path.join(upload_dir,
-                         'script_' + script_safe_filename))
+        checksums['script_' + script_safe_filename] = \
+            helpers.save_uploaded_file(
+                script_file,
+                os.path.join(upload_dir, 'script_' + script_safe_filename))
 
         # Save input files to upload directory
         for f in request.files.getlist('input_files'):
@@ -108,7 +129,9 @@ def submit(job_id=None):
                 # Remove unsupported characters from filename
                 safe_filename = secure_filename(f.filename)
                 # Save file to upload temp directory
-                f.save(os.path.join(upload_dir, 'input_' + safe_filename))
+                checksums['input_' + safe_filename] = \
+                    helpers.save_uploaded_file(
+                        f, os.path.join(upload_dir, 'input_' + safe_filename))
 
         # Assing the default value
         resource_url = 'localhost'
@@ -120,12 +143,32 @@ def submit(job_id=None):
         if form.new_resource.data not in (None, ''):
             resource_url = form.new_resource.data
 
+        # Each non empty line of parameter sets makes a job
+        parameter_sets = \
+            [line.strip() for line in (form.parameter_sets.data or '').
+             splitlines() if line.strip()]
+
         try:
+            if parameter_sets:
+                # Submit one job per parameter set
+                options = dict(form.data)
+                del options['parameter_sets']
+                job_ids = \
+                    job_services.submit_bulk(resource_url,
+                                             upload_dir,
+                                             script_type,
+                                             parameter_sets,
+                                             checksums=checksums,
+                                             **options)
+                flash('%s jobs submitted successfully' % len(job_ids),
+                      category='success')
+                return redirect(url_for('.index'))
             # Submit the job
             job_id = \
                 job_services.submit(resource_url,
                                     upload_dir,
                                     script_type,
+                                    checksums=checksums,
                                     **form.data)
             # Redirect to list
             return redirect(url_for('.detail', job_id=job_id))
@@ -180,6 +223,147 @@ def cancel(job_id):
     return redirect(url_for('.detail', job_id=job_id))
 
 
+def _check_live_updates():
+    """
+    Event streams keep a worker busy, they are only served if LIVE_UPDATES
+    is enabled.
+    """
+    if not current_app.config.get('LIVE_UPDATES'):
+        abort(404)
+
+
+def _get_stream_deadline():
+    """
+    Returns the time at which an event stream should be closed, so that the
+    client reconnects, or None to keep it open.
+    """
+    max_time = current_app.config.get('EVENTS_MAX_STREAM_TIME')
+    return time.time() + max_time if max_time else None
+
+
+@job_blueprint.route('/events', methods=['GET'])
+@login_required
+def events():
+    """
+    Stream state changes of jobs as server-sent events. Ids of jobs are given
+    as comma separated `ids' argument. Current states of the jobs are sent
+    first, then every change as soon as it happens. An `end' event is sent
+    once all jobs are in a terminal state. The stream is closed after
+    EVENTS_MAX_STREAM_TIME seconds and clients reconnect.
+    :return:
+    """
+    _check_live_updates()
+    try:
+        job_ids = [int(job_id)
+                   for job_id in request.args.get('ids', '').split(',')
+                   if job_id]
+    except ValueError:
+        abort(400)
+    max_jobs = current_app.config.get('EVENTS_MAX_JOBS')
+    if max_jobs and len(job_ids) > max_jobs:
+        abort(400)
+    states = job_services.get_job_statuses(job_ids)
+    # Finished jobs do not change anymore, only their states are sent
+    running = dict((job_id, state) for job_id, state in states.iteritems()
+                   if state not in TERMINAL_STATES)
+    subscription = job_events.subscribe(running)
+    keepalive_interval = current_app.config.get('EVENTS_KEEPALIVE_INTERVAL')
+    deadline = _get_stream_deadline()
+
+    def make_event(job_id, state):
+        return 'event: state\ndata: {0}\n\n'.format(
+            json.dumps({'job_id': job_id, 'state': state}))
+
+    def stream():
+        try:
+            for job_id, state in states.iteritems():
+                yield make_event(job_id, state)
+            while running and (deadline is None or time.time() < deadline):
+                timeout = keepalive_interval
+                if deadline is not None:
+                    timeout = min(timeout, max(deadline - time.time(), 0))
+                changes = subscription.get(timeout)
+                if not changes:
+                    # Detects closed connections and keeps proxies happy
+                    yield ': keepalive\n\n'
+                for job_id, state in changes:
+                    yield make_event(job_id, state)
+                    if state in TERMINAL_STATES:
+                        running.pop(job_id, None)
+            if not running:
+                yield 'event: end\ndata: \n\n'
+        finally:
+            subscription.close()
+
+    return Response(stream(),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+@job_blueprint.route('/<int:job_id>/output/<any(stdout, stderr):stream>',
+                     methods=['GET'])
+@login_required
+def output(job_id, stream):
+    """
+    Stream standard output or error of a job as server-sent events while it
+    grows. Event ids are offsets in the output, so reconnecting clients
+    continue where they stopped, e.g. after the stream is closed after
+    EVENTS_MAX_STREAM_TIME seconds.
+    :return:
+    """
+    _check_live_updates()
+    # Check access before streaming
+    job_services.get_job(job_id)
+    relation = FileRelation[stream]
+    offset = request.headers.get('Last-Event-ID',
+                                 request.args.get('offset', 0, type=int),
+                                 type=int)
+    if offset < 0:
+        abort(400)
+    interval = current_app.config.get('OUTPUT_POLL_INTERVAL')
+    deadline = _get_stream_deadline()
+
+    def generate(offset):
+        while deadline is None or time.time() < deadline:
+            try:
+                data, offset, finished = \
+                    job_services.read_output(job_id, relation, offset)
+            except JobManagerException, error:
+                yield 'event: error\ndata: {0}\n\n'.format(
+                    json.dumps(str(error)))
+                return
+            if data:
+                yield 'id: {0}\nevent: output\ndata: {1}\n\n'.format(
+                    offset, json.dumps(data.decode('utf-8', 'replace')))
+            if finished:
+                yield 'event: end\ndata: \n\n'
+                return
+            if not data:
+                # Detects closed connections while waiting for output
+                yield ': keepalive\n\n'
+                time.sleep(interval)
+
+    return Response(stream_with_context(generate(offset)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+@job_blueprint.route('/monitor', methods=['GET'])
+@login_required
+def monitor_stats():
+    """
+    Returns statistics of the running job monitors such as queue depth and
+    worker utilisation as json. Only available to administrators.
+    :return:
+    """
+    if not current_app.config.get('LOGIN_DISABLED') and \
+            current_user.get_role() != UserRole.admin:
+        abort(403)
+    return jsonify(monitors=read_monitor_stats(current_app))
+
+
 # This route is expecting a parameter containing the name
 # of a file. Then it will locate that file on the upload
 # directory and show it on the browser, so if the user uploads
@@ -189,21 +373,19 @@ def cancel(job_id):
 def get_file(job_id, file_name):
     # Get file location
     job_file = job_services.get_file_by_name(job_id, file_name)
-
-    # Add extra mime types
-    mimetypes.add_type('text/plain', '.lammps')
-    mimetypes.add_type('text/plain', '.couette')
-    return send_from_directory(job_file.location, job_file.name)
+    return helpers.send_staging_file(job_file)
 
 
 @job_blueprint.app_template_global(name='url_for_other_page')
-def url_for_other_page(page):
+def url_for_other_page(page, **kwargs):
     """
     Helper to create next page url
     :param page:
+    :param kwargs: extra url arguments, e.g. page cursors
     :return:
     """
     args = request.view_args.copy()
+    args.update(kwargs)
     args['page'] = page
     return url_for(request.endpoint, **args)
 
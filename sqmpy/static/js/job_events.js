@@ -0,0 +1,47 @@
+/*
+ * Updates job state labels, elements with a `data-job-status' attribute
+ * holding the job id, as state changes arrive from the job event stream.
+ */
+function watchJobStates(url) {
+    if (!window.EventSource) {
+        return;
+    }
+    var source = new EventSource(url);
+    source.addEventListener('state', function (event) {
+        var data = JSON.parse(event.data);
+        var label = 'label-info';
+        if (data.state === 'Done') {
+            label = 'label-success';
+        } else if (data.state === 'Failed') {
+            label = 'label-danger';
+        }
+        $('[data-job-status="' + data.job_id + '"]')
+            .text(data.state)
+            .removeClass('label-info label-success label-danger')
+            .addClass(label);
+    });
+    source.addEventListener('end', function () {
+        source.close();
+    });
+}
+
+/*
+ * Appends output of a job to the given element as it grows.
+ */
+function tailJobOutput(url, element) {
+    if (!window.EventSource) {
+        return;
+    }
+    var source = new EventSource(url);
+    source.addEventListener('output', function (event) {
+        $(element).append(document.createTextNode(JSON.parse(event.data)));
+    });
+    source.addEventListener('end', function () {
+        source.close();
+    });
+    source.addEventListener('error', function (event) {
+        if (event.data) {
+            source.close();
+        }
+    });
+}
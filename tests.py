@@ -5,6 +5,8 @@
     This file is part of sqmpy project.
 """
 import os
+import shutil
+import hashlib
 import unittest
 import tempfile
 
@@ -85,5 +87,698 @@ class SqmpyLoginTestCase(unittest.TestCase):
         assert 'Successfully logged in' in rv.data
 
 
+class SqmpyChecksumTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(10 * 1024)
+        fd, self.file_path = tempfile.mkstemp()
+        os.write(fd, self.data)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.file_path)
+
+    def test_chunked_checksum(self):
+        from sqmpy.job.helpers import get_file_checksum
+        # Use a chunk size which does not divide the file size
+        config = {'CHECKSUM_ALGORITHM': 'md5', 'CHECKSUM_CHUNK_SIZE': 1000}
+        assert get_file_checksum(self.file_path, config=config) ==\
+            hashlib.md5(self.data).hexdigest()
+        assert get_file_checksum(self.file_path, 'sha1', config) ==\
+            hashlib.sha1(self.data).hexdigest()
+
+
+class SqmpyBlobStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.staging_dir = tempfile.mkdtemp()
+        self.config = {'BLOB_STORE_DIR':
+                       os.path.join(self.staging_dir, 'blobs')}
+
+    def tearDown(self):
+        shutil.rmtree(self.staging_dir)
+
+    def make_file(self, name, data):
+        path = os.path.join(self.staging_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_deduplication(self):
+        from sqmpy.job import blobstore
+        checksum = hashlib.md5('data').hexdigest()
+        first = self.make_file('first', 'data')
+        second = self.make_file('second', 'data')
+        assert blobstore.add_file(first, checksum, self.config)
+        assert blobstore.add_file(second, checksum, self.config)
+        # Both files are links of the same blob
+        assert os.stat(first).st_ino == os.stat(second).st_ino
+        assert os.stat(first).st_nlink == 3
+
+        third = os.path.join(self.staging_dir, 'third')
+        blobstore.link_file(checksum, first, third, self.config)
+        assert os.stat(third).st_ino == os.stat(first).st_ino
+
+    def test_collect_garbage(self):
+        from sqmpy.job import blobstore
+        checksum = hashlib.md5('data').hexdigest()
+        path = self.make_file('first', 'data')
+        blobstore.add_file(path, checksum, self.config)
+        assert blobstore.collect_garbage(self.config) == 0
+        os.remove(path)
+        assert blobstore.collect_garbage(self.config) == 1
+        assert not os.path.exists(
+            blobstore.get_blob_path(checksum, self.config))
+
+
+class SqmpyJobTestCase(unittest.TestCase):
+    """
+    Base class of tests which need a logged in user and some jobs
+    """
+    def setUp(self):
+        self.db_fd, self.db_file = tempfile.mkstemp()
+        opts = {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' +
+                                           self.db_file +
+                                           '?check_same_thread=False',
+                'TESTING': True,
+                'WTF_CSRF_ENABLED': False,
+                'LOGIN_DISABLED': False,
+                'USE_LDAP_LOGIN': False,
+                'PER_PAGE': 50,
+                # Count jobs on every page view
+                'JOB_COUNT_CACHE_TIMEOUT': 0}
+        self.app = create_app(**opts)
+        self.client = self.app.test_client()
+        # Registering logs the user in
+        self.client.post('/register',
+                         data=dict(username='admin',
+                                   password='default',
+                                   confirm='default',
+                                   email='abc@abc.com'),
+                         follow_redirects=True)
+
+    def tearDown(self):
+        os.close(self.db_fd)
+        os.unlink(self.db_file)
+
+    def add_job(self, file_count):
+        from sqmpy.database import db
+        from sqmpy.job.models import Job, Resource, StagingFile
+        with self.app.app_context():
+            resource = Resource.query.filter_by(url='localhost').first()
+            if not resource:
+                resource = Resource('localhost')
+            job = Job()
+            job.script_type = 0
+            job.owner_id = 1
+            job.resource = resource
+            for i in range(file_count):
+                sf = StagingFile()
+                sf.name = 'file%s' % i
+                sf.relation = 0
+                sf.location = '/tmp'
+                job.files.append(sf)
+            db.session.add(job)
+            db.session.commit()
+            return job.id
+
+
+class SqmpyQueryCountTestCase(SqmpyJobTestCase):
+    def count_queries(self, url):
+        import threading
+        from sqlalchemy import event
+        from sqmpy.database import db
+        queries = []
+        thread = threading.current_thread()
+
+        def count(*args):
+            # Ignore queries of background threads
+            if threading.current_thread() is thread:
+                queries.append(args[2])
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            rv = self.client.get(url)
+            assert rv.status_code == 200
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        return len(queries)
+
+    def test_job_list_queries(self):
+        self.add_job(1)
+        few = self.count_queries('/jobs/')
+        for i in range(20):
+            self.add_job(1)
+        assert self.count_queries('/jobs/') == few
+
+    def test_job_detail_queries(self):
+        small_job = self.add_job(1)
+        large_job = self.add_job(20)
+        assert self.count_queries('/jobs/%s' % small_job) ==\
+            self.count_queries('/jobs/%s' % large_job)
+
+
+class SqmpyStoredJobStateTestCase(SqmpyJobTestCase):
+    def test_state_history_not_loaded(self):
+        from sqmpy.database import db
+        from sqmpy.job.constants import JobStatus
+        from sqmpy.job.models import Job
+        job_id = self.add_job(0)
+        with self.app.app_context():
+            job = Job.query.get(job_id)
+            job.set_state(JobStatus.SUBMITTING)
+            assert 'state_history' in db.inspect(job).unloaded
+            db.session.commit()
+            assert [record.new_state for record in job.state_history] == \
+                [JobStatus.INIT, JobStatus.SUBMITTING]
+
+
+class SqmpyJobListTestCase(SqmpyJobTestCase):
+    def list_job_ids(self, url):
+        import re
+        rv = self.client.get(url)
+        assert rv.status_code == 200
+        return [int(job_id) for job_id in
+                re.findall(r'data-job-status="(\d+)"', rv.data)]
+
+    def get_cursor(self, job_id):
+        from sqmpy.job.models import Job
+        from sqmpy.job.pagination import make_cursor
+        with self.app.app_context():
+            return make_cursor(Job.query.get(job_id))
+
+    def test_job_list(self):
+        job_ids = [self.add_job(0) for i in range(3)]
+        assert self.list_job_ids('/jobs/') == job_ids[::-1]
+
+    def test_job_list_pages(self):
+        self.app.config['PER_PAGE'] = 2
+        job_ids = [self.add_job(0) for i in range(5)]
+        assert self.list_job_ids('/jobs/page2') == job_ids[1:3][::-1]
+        assert self.list_job_ids('/jobs/page3') == job_ids[:1]
+
+    def test_job_list_cursors(self):
+        self.app.config['PER_PAGE'] = 2
+        job_ids = [self.add_job(0) for i in range(5)]
+        after = self.get_cursor(job_ids[3])
+        assert self.list_job_ids('/jobs/page2?after=%s' % after) ==\
+            job_ids[1:3][::-1]
+        before = self.get_cursor(job_ids[1])
+        assert self.list_job_ids('/jobs/page2?before=%s' % before) ==\
+            job_ids[2:4][::-1]
+        rv = self.client.get('/jobs/?after=invalid')
+        assert rv.status_code == 400
+
+
+class SqmpyApiTestCase(SqmpyJobTestCase):
+    def test_job_etag(self):
+        import json
+        job_id = self.add_job(2)
+        rv = self.client.get('/api/jobs/%s?fields=id,last_status' % job_id)
+        assert rv.status_code == 200
+        assert json.loads(rv.data) == {'id': job_id,
+                                       'last_status': 'Initialization'}
+        etag = rv.headers['ETag']
+        rv = self.client.get('/api/jobs/%s?fields=id,last_status' % job_id,
+                             headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+
+    def test_list_jobs(self):
+        import json
+        job_ids = [self.add_job(1) for i in range(3)]
+        rv = self.client.get('/api/jobs?fields=id&limit=2')
+        data = json.loads(rv.data)
+        assert [job['id'] for job in data['jobs']] == job_ids[:0:-1]
+        rv = self.client.get('/api/jobs?fields=id&limit=2&after=%s' %
+                             data['next'])
+        data = json.loads(rv.data)
+        assert [job['id'] for job in data['jobs']] == job_ids[:1]
+        assert data['next'] is None
+        rv = self.client.get('/api/jobs/%s/files?relation=input' %
+                             job_ids[0])
+        assert len(json.loads(rv.data)['files']) == 1
+
+
+class SqmpyFileServingTestCase(SqmpyJobTestCase):
+    def test_range_and_etag(self):
+        from sqmpy.database import db
+        from sqmpy.job.models import StagingFile
+        fd, path = tempfile.mkstemp()
+        os.write(fd, '0123456789')
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        job_id = self.add_job(0)
+        with self.app.app_context():
+            sf = StagingFile()
+            sf.name = os.path.basename(path)
+            sf.location = os.path.dirname(path)
+            sf.relation = 1
+            sf.checksum = hashlib.md5('0123456789').hexdigest()
+            sf.parent_id = job_id
+            db.session.add(sf)
+            db.session.commit()
+        url = '/jobs/%s/files/%s' % (job_id, os.path.basename(path))
+        rv = self.client.get(url, headers={'Range': 'bytes=2-4'})
+        assert rv.status_code == 206
+        assert rv.data == '234'
+        rv = self.client.get(url, headers={
+            'If-None-Match': '"%s"' % hashlib.md5('0123456789').hexdigest()})
+        assert rv.status_code == 304
+
+
+class SqmpyJobOutputTestCase(SqmpyJobTestCase):
+    def test_read_finished_output(self):
+        import json
+        from sqmpy.database import db
+        from sqmpy.job.models import Job, StagingFile
+        fd, path = tempfile.mkstemp()
+        os.write(fd, '0123456789')
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        job_id = self.add_job(0)
+        with self.app.app_context():
+            job = Job.query.get(job_id)
+            job.remote_job_id = '[fork://localhost]-[1]'
+            job.set_state('Done')
+            sf = StagingFile()
+            sf.name = os.path.basename(path)
+            sf.location = os.path.dirname(path)
+            sf.relation = 2
+            sf.parent_id = job_id
+            db.session.add(sf)
+            db.session.commit()
+        rv = self.client.get('/api/jobs/%s/output/stdout?offset=4' % job_id)
+        assert json.loads(rv.data) == {'data': '456789',
+                                       'offset': 10,
+                                       'finished': True}
+
+    def test_read_output_without_download(self):
+        import json
+        import threading
+        from sqmpy.database import db
+        from sqmpy.job import saga_helper
+        from sqmpy.job.models import Job
+        job_id = self.add_job(0)
+        with self.app.app_context():
+            job = Job.query.get(job_id)
+            job.remote_job_id = '[fork://localhost]-[1]'
+            job.set_state('Exception')
+            db.session.commit()
+        saga_helper._output_locks[(job_id, 2)] = threading.Lock()
+        saga_helper._output_fetch_times[(job_id, 2)] = 0
+        rv = self.client.get('/api/jobs/%s/output/stdout' % job_id)
+        assert json.loads(rv.data) == {'data': '',
+                                       'offset': 0,
+                                       'finished': True}
+        # Fetches of finished jobs are forgotten
+        assert (job_id, 2) not in saga_helper._output_locks
+        assert (job_id, 2) not in saga_helper._output_fetch_times
+
+    def test_negative_output_offset(self):
+        self.app.config['LIVE_UPDATES'] = True
+        job_id = self.add_job(0)
+        rv = self.client.get('/jobs/%s/output/stdout?offset=-1' % job_id)
+        assert rv.status_code == 400
+        rv = self.client.get('/jobs/%s/output/stdout' % job_id,
+                             headers={'Last-Event-ID': '-1'})
+        assert rv.status_code == 400
+
+
+class SqmpyJobSubmissionTestCase(SqmpyJobTestCase):
+    def test_fail_stale_jobs(self):
+        import datetime
+        from sqmpy.database import db
+        from sqmpy.job.constants import JobStatus
+        from sqmpy.job.models import Job
+        from sqmpy.job.submission import JobSubmissionPool
+        stale_job = self.add_job(0)
+        new_job = self.add_job(0)
+        with self.app.app_context():
+            for job in Job.query.all():
+                job.set_state(JobStatus.SUBMITTING)
+            Job.query.get(stale_job).submit_date -= datetime.timedelta(
+                hours=2)
+            db.session.commit()
+        pool = JobSubmissionPool(self.app)
+        assert pool.fail_stale_jobs(3600) == 1
+        with self.app.app_context():
+            assert Job.query.get(stale_job).last_status == JobStatus.FAILED
+            assert Job.query.get(new_job).last_status == \
+                JobStatus.SUBMITTING
+
+
+class SqmpyJobEventStreamTestCase(SqmpyJobTestCase):
+    def test_stream_closed_after_max_time(self):
+        self.app.config['LIVE_UPDATES'] = True
+        self.app.config['EVENTS_MAX_STREAM_TIME'] = 0.1
+        job_id = self.add_job(0)
+        rv = self.client.get('/jobs/events?ids=%s' % job_id)
+        assert rv.status_code == 200
+        assert '"job_id": %s' % job_id in rv.data
+        assert 'event: end' not in rv.data
+
+    def test_stream_ends_for_finished_jobs(self):
+        from sqmpy.database import db
+        from sqmpy.job.constants import JobStatus
+        from sqmpy.job.events import job_events
+        from sqmpy.job.models import Job
+        self.app.config['LIVE_UPDATES'] = True
+        self.app.config['EVENTS_MAX_STREAM_TIME'] = None
+        job_id = self.add_job(0)
+        with self.app.app_context():
+            Job.query.get(job_id).set_state(JobStatus.DONE)
+            db.session.commit()
+        rv = self.client.get('/jobs/events?ids=%s' % job_id)
+        assert '"state": "Done"' in rv.data
+        assert 'event: end' in rv.data
+        assert job_id not in job_events.get_job_ids()
+
+    def test_poll_changes_of_other_writers(self):
+        from sqmpy.database import db
+        from sqmpy.job.constants import JobStatus
+        from sqmpy.job.events import job_events, JobStatePoller
+        from sqmpy.job.models import Job
+        job_id = self.add_job(0)
+        subscription = job_events.subscribe({job_id: JobStatus.SUBMITTING})
+        self.addCleanup(subscription.close)
+        # Changes made outside of the monitor are published by the leader too
+        self.app.monitor.is_leader = True
+        with self.app.app_context():
+            Job.query.get(job_id).set_state(JobStatus.FAILED)
+            db.session.commit()
+        JobStatePoller(self.app).poll([job_id])
+        assert subscription.get(0) == [(job_id, JobStatus.FAILED)]
+
+    def test_streams_disabled(self):
+        job_id = self.add_job(0)
+        assert self.client.get('/jobs/events?ids=%s' % job_id).status_code \
+            == 404
+        assert self.client.get('/jobs/%s/output/stdout' % job_id) \
+            .status_code == 404
+        rv = self.client.get('/jobs/%s' % job_id)
+        assert 'watchJobStates' not in rv.data
+
+
+class SqmpyJobServicePoolTestCase(unittest.TestCase):
+    class Service(object):
+        closed = False
+
+        def __init__(self):
+            self.session = object()
+
+        def get_session(self):
+            return self.session
+
+        def close(self):
+            self.closed = True
+
+    class Context(object):
+        type = 'ssh'
+        user_id = 'user'
+
+    def setUp(self):
+        from sqmpy.job import saga_helper
+        self.addCleanup(setattr, saga_helper, '_create_job_service',
+                        saga_helper._create_job_service)
+        saga_helper._create_job_service = \
+            lambda endpoint, context: self.Service()
+
+    def test_evicted_service_closed_once_returned(self):
+        from sqmpy.job.saga_helper import JobServicePool
+        pool = JobServicePool(max_size=1)
+        first = pool.get('ssh://a', self.Context())
+        second = pool.get('ssh://b', self.Context())
+        assert not first.closed
+        pool.put(first)
+        assert first.closed
+        pool.put(second)
+        assert not second.closed
+        assert pool.get('ssh://b', self.Context()) is second
+
+    def test_idle_service_closed_once_returned(self):
+        from sqmpy.job.saga_helper import JobServicePool
+        pool = JobServicePool(idle_timeout=-1)
+        first = pool.get('ssh://a', self.Context())
+        shared = pool.get('ssh://a', self.Context())
+        assert shared is first
+        pool.get('ssh://b', self.Context())
+        pool.put(first)
+        pool.get('ssh://b', self.Context())
+        assert not first.closed
+        pool.put(shared)
+        pool.get('ssh://b', self.Context())
+        assert first.closed
+
+    def test_shells_of_returned_services(self):
+        from sqmpy.job.saga_helper import JobServicePool
+        pool = JobServicePool()
+        service = pool.get('ssh://a', self.Context())
+        pool.put(service)
+        # Shells are only kept for sessions of borrowed services
+        assert pool.get_shell('ssh://a', service.get_session()) is None
+
+
+class SqmpyMonitorSchedulerTestCase(unittest.TestCase):
+    class Context(object):
+        type = 'ssh'
+        user_id = None
+
+    def setUp(self):
+        from flask import Flask
+        from sqmpy.job.monitor import JobMonitorThread
+        app = Flask(__name__)
+        app.config.update(MONITOR_POLL_INTERVALS={'Running': 5},
+                          MONITOR_DEFAULT_POLL_INTERVAL=10,
+                          MONITOR_MAX_WORKERS_PER_RESOURCE=1)
+        self.monitor = JobMonitorThread(kwargs={'app': app})
+        self.context = self.Context()
+
+    def test_due_jobs_in_order(self):
+        import time
+        now = time.time()
+        self.monitor._schedule_job(1, 'ssh://a', self.context, now - 1)
+        self.monitor._schedule_job(2, 'ssh://a', self.context, now - 3)
+        self.monitor._schedule_job(3, 'ssh://a', self.context, now + 60)
+        assert [entry[2] for entry in self.monitor._pop_due()] == [2, 1]
+        # Job 3 is not due before the deadline
+        assert self.monitor._pop_due(time.time()) == []
+        assert len(self.monitor._schedule) == 1
+
+    def test_poll_intervals(self):
+        assert self.monitor.get_poll_interval('Running') == 5
+        assert self.monitor.get_poll_interval('Pending') == 10
+
+    def test_batches_per_resource(self):
+        entries = [(0, 0, 1, 'ssh://a', self.context),
+                   (0, 1, 2, 'ssh://b', self.context),
+                   (0, 2, 3, 'ssh://a', self.context)]
+        assert [(endpoint, job_ids) for _, endpoint, _, job_ids in
+                self.monitor._group_entries(entries)] == \
+            [('ssh://a', [1, 3]), ('ssh://b', [2])]
+        self.monitor.batch_polling = False
+        assert [job_ids for _, _, _, job_ids in
+                self.monitor._group_entries(entries)] == [[1], [2], [3]]
+
+    def test_deferred_batches(self):
+        from sqmpy.job.saga_helper import get_service_key
+        key = get_service_key('ssh://a', self.context)
+        other_key = get_service_key('ssh://b', self.context)
+        queue = self.monitor._work_queue
+        self.monitor._dispatch(key, 'ssh://a', self.context, [1])
+        self.monitor._dispatch(key, 'ssh://a', self.context, [2])
+        self.monitor._dispatch(key, 'ssh://a', self.context, [3])
+        # A busy resource does not hold back others
+        self.monitor._dispatch(other_key, 'ssh://b', self.context, [4])
+        assert [queue.get_nowait()[3] for i in range(queue.qsize())] == \
+            [[1], [4]]
+        # Deferred batches are polled together once a slot is free
+        self.monitor._finish('ssh://a')
+        assert queue.get_nowait()[3] == [2, 3]
+        assert queue.empty()
+
+    def test_slots_shared_by_users(self):
+        from sqmpy.job.saga_helper import get_service_key
+        other_user = self.Context()
+        other_user.user_id = 'other'
+        key = get_service_key('ssh://a', self.context)
+        other_key = get_service_key('ssh://a', other_user)
+        queue = self.monitor._work_queue
+        self.monitor._dispatch(key, 'ssh://a', self.context, [1])
+        # The resource is busy, no matter which user polls it
+        self.monitor._dispatch(other_key, 'ssh://a', other_user, [2])
+        self.monitor._dispatch(key, 'ssh://a', self.context, [3])
+        assert [queue.get_nowait()[3] for i in range(queue.qsize())] == \
+            [[1]]
+        # Batches of different users are not polled together
+        self.monitor._finish('ssh://a')
+        assert queue.get_nowait()[:2] == (other_key, 'ssh://a')
+        assert queue.empty()
+        self.monitor._finish('ssh://a')
+        assert queue.get_nowait()[:2] == (key, 'ssh://a')
+        assert queue.empty()
+
+
+class SqmpyMonitorLockTestCase(unittest.TestCase):
+    def test_single_holder(self):
+        from sqmpy.job.monitor import MonitorLock
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'monitor.lock')
+        first = MonitorLock(path)
+        second = MonitorLock(path)
+        assert first.acquire()
+        assert not second.acquire()
+        first.release()
+        assert second.acquire()
+        second.release()
+
+
+class SqmpyMonitorHandoverTestCase(SqmpyJobTestCase):
+    def make_monitor(self):
+        from sqmpy.job.monitor import JobMonitorThread
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config['MONITOR_LOCK_FILE'] = \
+            os.path.join(directory, 'monitor.lock')
+        return JobMonitorThread(kwargs={'app': self.app})
+
+    def submit_job(self):
+        from sqmpy.database import db
+        from sqmpy.job.models import Job
+        job_id = self.add_job(0)
+        with self.app.app_context():
+            job = Job.query.get(job_id)
+            job.remote_job_id = '[ssh://localhost]-[1]'
+            job.resource_endpoint = 'ssh://localhost'
+            db.session.commit()
+        return job_id
+
+    def test_leader_finds_jobs_of_others(self):
+        job_id = self.submit_job()
+        other = self.make_monitor()
+        other.send((job_id, 'ssh://localhost', None))
+        assert job_id not in other._monitored
+        leader = self.make_monitor()
+        leader.is_leader = True
+        assert leader.recover() == 1
+        assert job_id in leader._monitored
+        # Already monitored jobs are not scheduled again
+        assert leader.recover() == 0
+
+    def test_finished_jobs_not_recovered(self):
+        from sqmpy.database import db
+        from sqmpy.job.models import Job
+        job_id = self.submit_job()
+        finished_job_id = self.submit_job()
+        with self.app.app_context():
+            Job.query.get(finished_job_id).set_state('Exception')
+            db.session.commit()
+        leader = self.make_monitor()
+        leader.is_leader = True
+        assert leader.recover() == 1
+        assert leader._monitored == set([job_id])
+
+    def test_stats_of_running_monitors(self):
+        import json
+        from sqmpy.database import db
+        from sqmpy.security.constants import UserRole
+        from sqmpy.security.models import User
+        monitor = self.make_monitor()
+        monitor.write_stats()
+        self.addCleanup(monitor.remove_stats)
+        # Only administrators see monitor stats
+        assert self.client.get('/jobs/monitor').status_code == 403
+        with self.app.app_context():
+            User.query.get(1).role = UserRole.admin.value
+            db.session.commit()
+        rv = self.client.get('/jobs/monitor')
+        assert [stats['pid'] for stats in json.loads(rv.data)['monitors']] \
+            == [os.getpid()]
+
+    def test_local_monitoring_with_login_info(self):
+        self.app.config['SSH_WITH_LOGIN_INFO'] = True
+        job_id = self.submit_job()
+        monitor = self.make_monitor()
+        assert not monitor.discovery
+        monitor.send((job_id, 'ssh://localhost', None))
+        assert job_id in monitor._monitored
+
+
+class SqmpyJobStateTestCase(unittest.TestCase):
+    def test_state_history(self):
+        from sqmpy.job.models import Job
+        from sqmpy.job.constants import JobStatus
+        job = Job()
+        job.set_state(JobStatus.SUBMITTING)
+        assert job.last_status == JobStatus.SUBMITTING
+        assert [(record.old_state, record.new_state)
+                for record in job.state_history] ==\
+            [(None, JobStatus.INIT), (JobStatus.INIT, JobStatus.SUBMITTING)]
+
+
+class SqmpyConcurrentWriteTestCase(SqmpyJobTestCase):
+    def test_concurrent_writes(self):
+        import datetime
+        import threading
+        from sqmpy.database import db
+        from sqmpy.job.models import Job, JobStateHistory, StagingFile
+        from sqmpy.job.monitor import StateWriter
+        job_id = self.add_job(0)
+        errors = []
+
+        def download(worker):
+            # Workers record downloaded files while states are written
+            with self.app.app_context():
+                try:
+                    for i in range(20):
+                        sf = StagingFile()
+                        sf.name = 'out%s.%s' % (worker, i)
+                        sf.relation = 1
+                        sf.location = '/tmp'
+                        sf.parent_id = job_id
+                        db.session.add(sf)
+                        db.session.commit()
+                except Exception, error:
+                    errors.append(error)
+                finally:
+                    db.session.remove()
+
+        def write_states():
+            writer = StateWriter(self.app)
+            for i in range(20):
+                writer.write([(job_id, 'Pending', 'Running',
+                               datetime.datetime.utcnow())])
+
+        threads = [threading.Thread(target=download, args=(i,))
+                   for i in range(4)]
+        threads.append(threading.Thread(target=write_states))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # No `database is locked' errors with WAL and busy timeout
+        assert errors == []
+        with self.app.app_context():
+            assert StagingFile.query.count() == 80
+            assert JobStateHistory.query.filter(
+                JobStateHistory.job_id == job_id,
+                JobStateHistory.new_state == 'Running').count() == 20
+            assert Job.query.get(job_id).last_status == 'Running'
+
+
+class SqmpyJobEventsTestCase(unittest.TestCase):
+    def test_publish(self):
+        from sqmpy.job.events import JobEvents
+        events = JobEvents()
+        subscription = events.subscribe({1: 'New', 2: 'New'})
+        events.publish(1, 'Running')
+        # Known states and other jobs are not delivered
+        events.publish(2, 'New')
+        events.publish(3, 'Running')
+        assert subscription.get(0) == [(1, 'Running')]
+        assert subscription.get(0) == []
+        subscription.close()
+        assert events.get_job_ids() == []
+
+
 if __name__ == '__main__':
     unittest.main()